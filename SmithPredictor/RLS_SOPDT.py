@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Online SOPDT identification by recursive least squares
+
+The SOPDT model of SysID_SOPDT.py, discretized with the CO held over
+each sample step h, is the second order ARX model
+
+    y[n] = a1 y[n-1] + a2 y[n-2] + b1 u[n-1-d] + b2 u[n-2-d] + e
+
+for dead time d steps.  One recursive least squares (RLS) estimator of
+(a1, a2, b1, b2, e), with exponential forgetting, runs per candidate
+dead time in a small bank; the bank member with the smallest forgotten
+sum of squared prediction errors gives the dead time.  Each new sample
+costs a fixed amount of work, for a fixed bank size, so the estimates
+can follow slow changes of the process indefinitely.
+
+The estimates convert back to the continuous-time SOPDT parameters k,
+t0, t1, c and dt of go_main in SysID_SOPDT.py, and to the same ISA PID
+parameters.
+"""
+import os
+import sys
+import numpy as np
+
+
+def sopdt_parameters(theta, d, h):
+    """ return SOPDT parameters k, t0, t1, c, dt for ARX parameters
+        theta = (a1, a2, b1, b2, e), dead time d steps, and step h.
+        The poles z of the ARX model give the time constants -h/ln(z);
+        complex poles give two equal time constants, from their modulus,
+        poles at or below 0 decay within a step, and give 0, and poles at
+        or above 1 do not decay, and give NaN """
+    a1, a2, b1, b2, e = theta
+    _den = 1.0 - a1 - a2                # steady state:  y = k*u + c
+    _disc = a1*a1 + 4.0*a2
+    if _disc >= 0.0:
+        _z = np.array([a1 + np.sqrt(_disc), a1 - np.sqrt(_disc)]) / 2.0
+    else:
+        _z = np.full(2, np.sqrt(-a2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        _t = np.where(_z <= 0.0, 0.0,
+                      np.where(_z < 1.0, -h / np.log(_z), np.nan))
+    return np.array([(b1 + b2) / _den, _t[0], _t[1], e / _den, d * h])
+
+
+class RecursiveSOPDT:
+    """ RLS estimator bank of SOPDT parameters; see module docstring
+
+        h:  grid step; samples are put on this grid, with the CO and PV
+            held between samples, and any samples between grid times
+            change only the held CO
+        delays:  candidate dead times, in steps
+        forgetting:  RLS forgetting factor, 0 < forgetting <= 1; the
+                     estimates have a memory of about h/(1-forgetting)
+        p0:  initial diagonal of the RLS covariance matrices """
+    def __init__(self, h, delays=range(0, 41), forgetting=0.999, p0=1e4):
+        self.h, self.forgetting = float(h), float(forgetting)
+        self.delays = np.asarray(delays, dtype=int)
+        D = len(self.delays)
+        self.theta = np.zeros((D, 5))
+        self.P = np.tile(np.eye(5) * p0, (D, 1, 1))
+        self.cost = np.zeros(D)         # forgotten sums of squared errors
+        self.L = self.delays.max() + 2  # CO ring buffer length
+        self.ubuf = np.zeros(self.L)
+        self.pos = 0                    # ubuf[pos] is u[n-1]
+        self.t = None
+        self.nsteps = 0
+
+    def update(self, t, u, y):
+        """ add one (time, CO, PV) sample """
+        if self.t is None:
+            self.ubuf[:] = u
+            self.t, self.u, self.y1, self.y2 = t, u, y, y
+            return
+        # grid steps since last grid time self.t; samples between grid
+        # times only update the held CO
+        _m = int(np.floor((t - self.t) / self.h + 1e-6))
+        for _i in range(_m - 1):
+            self.step(self.y1, self.u)
+        if _m > 0: self.step(y, u)
+        self.t, self.u = self.t + _m * self.h, u
+
+    def step(self, y, u):
+        """ advance one grid step:  y is the PV at this step, and u the
+            CO from this step to the next """
+        lam = self.forgetting
+        _phi = np.empty((len(self.delays), 5))
+        _phi[:,0], _phi[:,1], _phi[:,4] = self.y1, self.y2, 1.0
+        _phi[:,2] = self.ubuf[(self.pos + self.delays) % self.L]
+        _phi[:,3] = self.ubuf[(self.pos + self.delays + 1) % self.L]
+
+        # RLS update of every bank member at once
+        _Pphi = np.einsum('dij,dj->di', self.P, _phi)
+        _K = _Pphi / (lam + np.einsum('di,di->d', _phi, _Pphi))[:,np.newaxis]
+        _err = y - np.einsum('di,di->d', _phi, self.theta)
+        self.theta += _K * _err[:,np.newaxis]
+        self.P = (self.P - np.einsum('di,dj->dij', _K, _Pphi)) / lam
+        self.P = 0.5 * (self.P + self.P.transpose(0, 2, 1))
+        self.cost = lam * self.cost + _err * _err
+
+        # shift PV history and CO ring buffer
+        self.y2, self.y1 = self.y1, y
+        self.pos = (self.pos - 1) % self.L
+        self.ubuf[self.pos] = u
+        self.nsteps += 1
+
+    def best(self):
+        """ index in bank of candidate dead time with least cost """
+        return int(np.argmin(self.cost))
+
+    def estimate(self):
+        """ return current SOPDT parameters k, t0, t1, c, dt """
+        _i = self.best()
+        return sopdt_parameters(self.theta[_i], self.delays[_i], self.h)
+
+    def run(self, aTime, aCO, aPV):
+        """ add arrays of samples, e.g. from readCSV or read_XLSX; return
+            current estimate """
+        for _t, _u, _y in zip(aTime, aCO, aPV):
+            self.update(_t, _u, _y)
+        return self.estimate()
+
+    def track(self, samples, every=1):
+        """ generator:  add (time, CO, PV) samples from any iterable, such
+            as a live stream, yielding (time, estimate) every few samples,
+            or never if every is 0 """
+        for _n, (_t, _u, _y) in enumerate(samples):
+            self.update(_t, _u, _y)
+            if every and 0 == (_n + 1) % every and self.nsteps > 2:
+                yield _t, self.estimate()
+
+
+def samples_from_blocks(blocks):
+    """ generator:  (time, CO, PV) samples from (aTime, aCO, aPV) blocks,
+        e.g. read_interleaved_XLSX.stream_interleaved, for track """
+    for _block in blocks:
+        for _sample in zip(*_block):
+            yield _sample
+
+
+def parse_delays(s, h):
+    """ parse candidate dead times 'lo:hi[:step]', in time units, to
+        whole steps of h """
+    _toks = list(map(float, str(s).split(':')))
+    lo, hi, step = (_toks + [h])[:3]
+    return np.unique(np.round(np.arange(lo, hi + 0.5*step, step) / h).astype(int))
+
+
+def go_main(path='Hotrod.txt', step=None, delays=None, forgetting=0.999,
+            every=0, interleaved=False):
+    """ identify SOPDT model of CSV file at path, one sample at a time
+
+ Arguments:
+
+   path:  CSV file for readCSV_fast to read
+   interleaved:  path is instead a CSV/TSV historian export in the
+                 interleaved layout of ../Tank*.xlsx, streamed in
+                 blocks by read_interleaved_XLSX.stream_interleaved,
+                 with decreasing backlash; step is required
+   step:  grid step h; default is the largest step on which all of
+          the sample times fall.  Equation-error estimates such as RLS
+          are biased by PV noise, mostly in the smaller time constant;
+          a coarser step reduces that bias
+   delays:  candidate dead times 'lo:hi[:step]', in time units;
+            default 0 to 40 steps
+   forgetting:  RLS forgetting factor
+   every:  print estimate every this many samples; 0 for final only
+"""
+    from readCSV import readCSV_fast
+    from SysID_SOPDT import time_grid_step, print_sopdt
+
+    if interleaved:
+        assert step, 'Interleaved input requires step'
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        import read_interleaved_XLSX as riX
+        h = float(step)
+        samples = samples_from_blocks(riX.stream_interleaved(path, decreasing_backlash=True))
+    else:
+        aTime, aCO, aPV = readCSV_fast(path)
+        h = float(step or time_grid_step(aTime) or np.median(np.diff(aTime)))
+        samples = zip(aTime, aCO, aPV)
+    est = RecursiveSOPDT(h, range(0, 41) if delays is None else parse_delays(delays, h),
+                         forgetting=float(forgetting))
+    every = int(every)
+    if every: print("      time        k       t0       t1        c       dt")
+    for _t, x in est.track(samples, every):
+        print("{0:10.1f} {1}".format(_t, ' '.join(map('{0:8.4g}'.format, x))))
+    x = est.estimate()
+    print("Step h             = {:7.3f}".format(h))
+    print_sopdt(x)
+    return x
+
+
+if "__main__" == __name__:
+    """
+Usage:
+
+  python                    \\
+    RLS_SOPDT.py            \\
+    [--path=Hotrod.txt]     \\
+    [--step=H]              \\
+    [--delays=lo:hi[:step]] \\
+    [--forgetting=0.999]    \\
+    [--every=N]             \\
+    [--interleaved]
+
+  python RLS_SOPDT.py --step=10 --delays=0:40
+
+  python RLS_SOPDT.py --path=Tank_data_dbacklash.txt --step=300 --delays=0:3000 --forgetting=1
+
+"""
+    kwargs = dict()
+    for arg in sys.argv[1:]:
+      if arg.startswith('--'):
+        toks = arg[2:].split('=')
+        key = toks.pop(0)
+        L = len(toks)
+        if L: val = '='.join(toks)
+        else: val = True
+        kwargs[key] = val
+
+    go_main(**kwargs)
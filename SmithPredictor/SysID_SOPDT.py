@@ -11,17 +11,17 @@ Ca. 2021-03-07
 """
 import os
 import sys
+import multiprocessing
 from math import sqrt
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.interpolate import interp1d
-from scipy.optimize import minimize
-from scipy.integrate import odeint
-from readCSV import readCSV
+from readCSV import readCSV_fast
+
+# scipy and matplotlib are imported where they are used, so that scripts
+# that only need part of this module (e.g. print_sopdt) start quickly
 
 Hotrod_pv0 = [3.75733754,170.95853484,41.07003168,77.84619886,21.24783755]
 
-def difeq(y, t, k, t0, t1, c, dt ):
+def difeq(y, t, k, t0, t1, c, dt, control_interp):
     """ generate estimated SOPDT solution
         y[0] = process value
         y[1] = rate of change of the process value"""
@@ -31,21 +31,135 @@ def difeq(y, t, k, t0, t1, c, dt ):
     return np.array([y[1], _dy2dt])
 
 
-def t0p2(p, aTime, aPV):
+class OdeintSOPDT:
+    """ SOPDT model of CO data, integrated with odeint; the CO is linearly
+        interpolated between samples, and held at its first value before
+        the first sample time """
+    def __init__(self, aTime, aCO):
+        from scipy.interpolate import interp1d
+        self.aTime = aTime
+        self.control_interp = interp1d(aTime, aCO, kind='linear',
+                                       bounds_error=False,
+                                       fill_value='extrapolate')
+
+    def simulate(self, p, pv0):
+        """ return estimated process values at sample times
+            p:  k, t0, t1, c, dt; see t0p2 below
+            pv0:  initial process value and rate """
+        from scipy.integrate import odeint
+        _k,_t0,_t1,_c,_dt = p
+        return odeint(difeq, pv0, self.aTime,
+                      args=(_k, _t0, _t1, _c, _dt, self.control_interp))[:,0]
+
+
+def time_grid_step(aTime, tol=1e-6):
+    """ largest step h such that every sample time is a whole number of
+        steps after the first; None if there is no such step """
+    h = 0.0
+    for _d in np.unique(np.round(np.diff(aTime), 9)):
+        while _d > tol:                 # Euclid's algorithm on floats
+            h, _d = _d, h % _d
+        if h <= tol: return None
+    _n = (aTime - aTime[0]) / h
+    return np.allclose(_n, np.round(_n), rtol=0.0, atol=tol) and h or None
+
+
+class DiscreteSOPDT:
+    """ SOPDT model of CO data, as an exact discrete-time simulation
+
+        The sample times are put on a uniform grid of step h, over each
+        step of which the delayed CO is either linear with one knot where
+        the fractional part of the dead time falls (hold='foh', matching
+        the linear interpolation used by OdeintSOPDT), or constant on each
+        side of that point (hold='zoh').  The SOPDT state then advances
+        per step as x[n+1] = Phi x[n] + s[n], where Phi and the weights
+        of the CO samples in s[n] come from matrix exponentials, and the
+        process value obeys a second order linear recurrence, which is
+        run by scipy.signal.lfilter.  Any dead time is handled, so the
+        result matches OdeintSOPDT to the accuracy of the ODE solver """
+    def __init__(self, aTime, aCO, hold='foh', max_grid_ratio=100):
+        h = time_grid_step(aTime)
+        if not h:
+            raise ValueError('Sample times are not on a uniform grid')
+        _idx = np.round((aTime - aTime[0]) / h).astype(int)
+        if _idx[-1] + 1 > max_grid_ratio * len(aTime):
+            raise ValueError('Time grid step {0} is too fine'.format(h))
+        assert hold in ('foh', 'zoh'), 'Unknown hold [{0}]'.format(hold)
+        self.h, self.idx, self.hold = h, _idx, hold
+        aGrid = aTime[0] + h * np.arange(_idx[-1] + 1)
+        if 'foh' == hold: self.aCOgrid = np.interp(aGrid, aTime, aCO)
+        else            : self.aCOgrid = aCO[np.searchsorted(aTime, aGrid + 0.5*h, 'right') - 1]
+
+    def piece(self, A, B, tau):
+        """ state transition, constant-input and input-slope terms of
+            x' = A x + B v over an interval tau with v linear in time """
+        from scipy.linalg import expm
+        _M = np.zeros((4, 4))
+        _M[:2,:2], _M[:2,2], _M[2,3] = A, B, 1.0
+        _E = expm(_M * tau)
+        return _E[:2,:2], _E[:2,2], _E[:2,3]
+
+    def simulate(self, p, pv0):
+        """ return estimated process values at sample times
+            p:  k, t0, t1, c, dt; see t0p2 below
+            pv0:  initial process value and rate """
+        from scipy.signal import lfilter, lfiltic
+        _k,_t0,_t1,_c,_dt = p
+        h, G = self.h, len(self.aCOgrid)
+        A = np.array([[0.0, 1.0], [-1.0/(_t0*_t1), -(_t0+_t1)/(_t0*_t1)]])
+        B = np.array([0.0, 1.0/(_t0*_t1)])
+
+        # split dead time into whole steps d and fraction f of a step
+        d = int(np.floor(_dt / h))
+        f = _dt / h - d
+        _v = _k * self.aCOgrid + _c     # input to SOPDT, incl. bias
+        _j = np.arange(G - 1) - d       # steps' delayed grid indices
+        vm1, v0, vp1 = [_v[np.clip(_j + o, 0, G-1)] for o in (-1, 0, 1)]
+
+        # piece 1 lasts f*h, piece 2 the rest of each step
+        Phi1, G1a, G2a = self.piece(A, B, f * h)
+        Phi2, G1b, G2b = self.piece(A, B, (1.0 - f) * h)
+        Phi = Phi2 @ Phi1
+        if 'foh' == self.hold:
+            # delayed input:  start, knot, end of step
+            Sa = G2a / (f * h) if f > 0.0 else 0.0 * G2a
+            Sb = G2b / ((1.0 - f) * h) if f < 1.0 else 0.0 * G2b
+            _s = (np.outer(f * vm1 + (1.0 - f) * v0, Phi2 @ (G1a - Sa))
+                 + np.outer(v0, Phi2 @ Sa + G1b - Sb)
+                 + np.outer(f * v0 + (1.0 - f) * vp1, Sb))
+        else:
+            _s = np.outer(vm1, Phi2 @ G1a) + np.outer(v0, G1b)
+
+        # y[n+2] = tr y[n+1] - det y[n] + s1[n+1] - Phi22 s1[n] + Phi12 s2[n]
+        tr, det = Phi[0,0] + Phi[1,1], Phi[0,0]*Phi[1,1] - Phi[0,1]*Phi[1,0]
+        _y = np.empty(G)
+        _y[0] = pv0[0]
+        if G > 1: _y[1] = (Phi @ pv0 + _s[0])[0]
+        if G > 2:
+            _F = _s[1:,0] - Phi[1,1] * _s[:-1,0] + Phi[0,1] * _s[:-1,1]
+            _a = [1.0, -tr, det]
+            _y[2:] = lfilter([1.0], _a, _F,
+                             zi=lfiltic([1.0], _a, [_y[1], _y[0]]))[0]
+        return _y[self.idx]
+
+
+def t0p2(p, aTime, aPV, model, verbose=True):
     """find the values of a1 and a2 that minimize the ITAE3
 p[0]:  open loop extend gain
 p[1]:  time constant 0
 p[2]:  time constant 1
 p[3]:  output offset or bias
 p[4]:  deadtime
+model:  DiscreteSOPDT or OdeintSOPDT instance for aTime and CO data
+verbose:  print sse of each evaluation
 
 """
-    _k,_t0,_t1,_c,_dt = p  #
     _pv0 = [aPV[0], 0.0]                # initial process value and rate
-    _aEV = odeint(difeq, _pv0, aTime, args=(_k, _t0, _t1, _c, _dt))
-    _sse = np.sum((aPV-_aEV[:,0])**2)
-    print("sse = {}".format(_sse))
-    return _sse
+    with np.errstate(over='ignore', invalid='ignore'):
+        _aEV = model.simulate(p, _pv0)
+        _sse = np.sum((aPV-_aEV)**2)
+    if verbose: print("sse = {}".format(_sse))
+    return _sse if np.isfinite(_sse) else np.inf
 
 
 def plot_data(aTimes, aPV, aEV, aCO,title):
@@ -54,6 +168,7 @@ def plot_data(aTimes, aPV, aEV, aCO,title):
         aPV is the array of provided process variable
         aEV is the array of estimated process variable
         aCO is the array of provieded control output """
+    import matplotlib.pyplot as plt
     _fig, (_ax0,_axCO,) = plt.subplots(nrows=2,ncols=1
                                       ,sharex=True
                                       ,gridspec_kw=dict(height_ratios=[3,1])
@@ -76,7 +191,139 @@ def plot_data(aTimes, aPV, aEV, aCO,title):
     plt.show()
 
 
-def go_main(method='Nelder-Mead',path='Hotrod.txt',pv0=Hotrod_pv0):
+def make_model(aTime, aCO, odeint_model=False, hold='foh'):
+    """ DiscreteSOPDT model of CO data, or OdeintSOPDT if odeint_model is
+        True or the sample times are not on a usable uniform grid """
+    if not odeint_model:
+        try:
+            return DiscreteSOPDT(aTime, aCO, hold=hold)
+        except ValueError as e:
+            sys.stderr.write('WARNING:  {0}; using odeint\n'.format(e))
+    return OdeintSOPDT(aTime, aCO)
+
+
+def isa_pid(x):
+    """ return the controller ISA PID parameters for SOPDT parameters x:
+        closed loop time constant, controller gain, integrator and
+        derivative time constants """
+    k, t0, t1, c, dt = x
+    tc = max(0.1*max(t0,t1),0.8*dt)     # closed loop time constant
+    kc = (t0+t1)/(k*(tc+dt))            # controller gain %CO/error
+    ti = t0+t1                          # integrator time constant
+    td = t0*t1/(t0+t1)                  # derivative time constant
+    return tc, kc, ti, td
+
+
+def print_sopdt(x):
+    """ print SOPDT parameters x, and the ISA PID parameters for them """
+    print("The open loop gain = {:7.3f} PV/%CO".format(x[0]))
+    print("Time constant 0    = {:7.3f}".format(x[1]))
+    print("Time constant 1    = {:7.3f}".format(x[2]))
+    print("Ambient PV         = {:7.3f} in PV units".format(x[3]))
+    print("Dead time          = {:7.3f}".format(x[4]))
+    print("Time units are the same as provided in input file")
+    # calculate the controller ISA PID parameters
+    tc, kc, ti, td = isa_pid(x)
+    print("The closed loop time constant = {:7.3f}".format(tc))
+    print("The controller gain           = {:7.3f} %CO/unit of error"
+          .format(kc))
+    print("The integrator time constant  = {:7.3f}".format(ti))
+    print("The derivative time constant  = {:7.3f}".format(td))
+
+
+class EarlyStop(Exception):
+    """ raised inside an objective evaluation to abandon one start """
+    pass
+
+
+# per-worker-process data for multi_start_fit
+_ms = dict()
+
+def _ms_init(aTime, aCO, aPV, odeint_model, hold, best):
+    """ multi_start_fit worker initializer:  build model once """
+    _ms.update(aTime=aTime, aPV=aPV, best=best,
+               model=make_model(aTime, aCO, odeint_model=odeint_model, hold=hold))
+
+
+def _ms_fit(job):
+    """ run one start of multi_start_fit; see there """
+    istart, x0, method, patience, abort_ratio = job
+    best = _ms['best']
+    history = [np.inf]                  # run's best sse after each call
+    bestx = [np.array(x0, dtype=float)]
+
+    def objective(p):
+        _sse = t0p2(p, _ms['aTime'], _ms['aPV'], _ms['model'], verbose=False)
+        if _sse < history[-1]: bestx[0] = np.array(p)
+        history.append(min(history[-1], _sse))
+        if _sse < best.value:
+            with best.get_lock():
+                if _sse < best.value: best.value = _sse
+        # abandon run when, after patience calls, it is abort_ratio times
+        # worse than the best of all runs, and its improvement over the
+        # last patience calls could not close that gap in as many more
+        if len(history) > patience and history[-1] > abort_ratio * best.value:
+            if history[-1-patience] - history[-1] < history[-1] - best.value:
+                raise EarlyStop()
+        return _sse
+
+    from scipy.optimize import minimize
+    stopped = False
+    try:
+        res = minimize(objective, x0, method=method)
+        # do again to avoid local minimum
+        res = minimize(objective, res.x, method=method)
+    except EarlyStop:
+        stopped = True
+    return dict(start=istart, x0=np.array(x0), x=bestx[0], sse=history[-1],
+                nfev=len(history)-1, stopped=stopped)
+
+
+def multi_start_fit(aTime, aCO, aPV, bounds, nstarts, method='Nelder-Mead',
+                    odeint_model=False, hold='foh', processes=None,
+                    seed=None, patience=200, abort_ratio=2.0):
+    """ fit SOPDT model from nstarts starting points, in parallel
+
+        Starting points are a Latin hypercube sample of bounds, a list of
+        (lo, hi) pairs for gain, both time constants, bias and dead time.
+        Each start runs in a worker process of a pool; the best sse over
+        all runs is shared among the workers, and a run is abandoned
+        once it is clearly unable to beat it (see _ms_fit).
+
+        Returns results ranked by sse, each a dict with keys start, x0,
+        x, sse, nfev, stopped and isa (tc, kc, ti, td from isa_pid);
+        abandoned runs are ranked last, with their best x so far """
+    from scipy.stats import qmc
+    lo, hi = np.array(bounds, dtype=float).T
+    starts = qmc.scale(qmc.LatinHypercube(d=len(lo), seed=seed).random(nstarts), lo, hi)
+    best = multiprocessing.Value('d', np.inf)
+    jobs = [(i, list(x0), method, patience, abort_ratio)
+            for i, x0 in enumerate(starts)]
+    with multiprocessing.Pool(processes or None, initializer=_ms_init,
+                              initargs=(aTime, aCO, aPV, odeint_model,
+                                        hold, best)) as pool:
+        results = list(pool.imap_unordered(_ms_fit, jobs))
+    for result in results: result['isa'] = isa_pid(result['x'])
+    return sorted(results, key=lambda result: (result['stopped'], result['sse']))
+
+
+def parse_floats(s):
+    """ parse '[a,b,...]' or '(a,b,...)' string to list of floats """
+    return list(map(float,s.strip().lstrip('([').rstrip('])').split(',')))
+
+
+def default_bounds(pv0):
+    """ multi-start bounds:  a factor of 4 either side of each of pv0,
+        and from 0 for the dead time """
+    bounds = [tuple(sorted((0.25*p, 4.0*p))) if p else (-1.0, 1.0) for p in pv0]
+    bounds[4] = (0.0, max(bounds[4][1], 1.0))
+    return bounds
+
+
+def go_main(method='Nelder-Mead',path='Hotrod.txt',pv0=Hotrod_pv0
+           ,odeint_model=False,hold='foh'
+           ,multi_start=0,bounds=None,processes=0,seed=None
+           ,patience=200,abort_ratio=2.0):
     """ enter path and file name for csv that has data to use for
  system identification.
  The file must have a header with three columns.
@@ -87,59 +334,70 @@ def go_main(method='Nelder-Mead',path='Hotrod.txt',pv0=Hotrod_pv0):
  Arguments:
 
    method:  minimize method to read, Nelder-Mead or BFGS or Powell
-   path:  CSV file for readCSV to read
+   path:  CSV file for readCSV_fast to read
+   odeint_model:  True to integrate the model with odeint, instead of
+                  the exact discrete-time simulation of DiscreteSOPDT
+   hold:  DiscreteSOPDT input between samples, foh (linear) or zoh
    pv0:  initial guesses for the parameter array
            pv0[0]:  open loop extend gain
            pv0[1]:  time constant 0
            pv0[2]:  time constant 1
            pv0[3]:  output offset or bias
            pv0[4]:  deadtime
+   multi_start:  number of starting points for multi_start_fit; 0 to
+                 fit once from pv0
+   bounds:  multi-start (lo, hi) per parameter, as 'lo:hi,lo:hi,...';
+            default from pv0, see default_bounds
+   processes:  multi-start worker processes; 0 for one per CPU
+   seed:  multi-start random seed
+   patience, abort_ratio:  multi-start early stopping; see _ms_fit
 
 """
-    global control_interp
     # Parse pv0 argument if string
     if isinstance(pv0,str):
-      lcl_pv0 = list(map(float,pv0.strip().lstrip('([').rstrip('])').split(',')))
+      lcl_pv0 = parse_floats(pv0)
     else:
       lcl_pv0 = pv0
     # tab separated variable with string header
-    aTime, aCO, aPV = readCSV(path)
-    N = len(aTime)
-    aEV = np.zeros((N,2))               # estimated PV and PV'
-    control_interp = interp1d(aTime, aCO, kind='linear',
-                          bounds_error=False, fill_value='extrapolate')
-    res = minimize(t0p2, lcl_pv0, args=(aTime, aPV), method=method)
-    # do again to avoid local minimum
-    res = minimize(t0p2, res.x, args=(aTime, aPV), method=method)
-    print(res)
-    k = res.x[0]        # open loop gain.  PV change / %control output
-    t0 = res.x[1]       # time constant 0
-    t1 = res.x[2]       # time constant 1
-    c = res.x[3]        # PV offset, ambient PV
-    dt = res.x[4]       # dead time
+    aTime, aCO, aPV = readCSV_fast(path)
+    model = make_model(aTime, aCO, odeint_model=odeint_model, hold=hold)
+    if int(multi_start):
+        if isinstance(bounds,str):
+          bounds = [tuple(map(float,b.split(':'))) for b in bounds.split(',')]
+        results = multi_start_fit(aTime, aCO, aPV,
+                                  bounds or default_bounds(lcl_pv0),
+                                  int(multi_start), method=method,
+                                  odeint_model=odeint_model, hold=hold,
+                                  processes=int(processes),
+                                  seed=None if None is seed else int(seed),
+                                  patience=int(patience),
+                                  abort_ratio=float(abort_ratio))
+        print(" rank start      sse  nfev  stop"
+              "        k       t0       t1        c       dt"
+              "       kc       ti       td")
+        for rank, result in enumerate(results):
+            print("{0:5d} {1:5d} {2:8.4g} {3:5d} {4:5s} {5} {6}".format(
+                  rank, result['start'], result['sse'], result['nfev'],
+                  result['stopped'] and 'yes' or 'no',
+                  ' '.join(map('{0:8.4g}'.format, result['x'])),
+                  ' '.join(map('{0:8.4g}'.format, result['isa'][1:]))))
+        x, fun = results[0]['x'], results[0]['sse']
+    else:
+        from scipy.optimize import minimize
+        res = minimize(t0p2, lcl_pv0, args=(aTime, aPV, model), method=method)
+        # do again to avoid local minimum
+        res = minimize(t0p2, res.x, args=(aTime, aPV, model), method=method)
+        print(res)
+        x, fun = res.x, res.fun
     # initial process value and rate of change
     pv1 = [aPV[0], (aPV[1]-aPV[0])/(aTime[1]-aTime[0])]
-    aEV = odeint(difeq, pv1, aTime, args=(k, t0, t1, c, dt ))
-    plot_data(aTime, aPV, aEV[:,0], aCO
-             , '{0}\n{1}'.format(os.path.basename(path),','.join(map('{0:.3e}'.format,res.x)))
+    aEV = model.simulate(x, pv1)
+    plot_data(aTime, aPV, aEV, aCO
+             , '{0}\n{1}'.format(os.path.basename(path),','.join(map('{0:.3e}'.format,x)))
              )
-    print("RMS error          = {:7.3f}".format(sqrt(res.fun/len(aTime))))
-    print("The open loop gain = {:7.3f} PV/%CO".format(res.x[0]))
-    print("Time constant 0    = {:7.3f}".format(res.x[1]))
-    print("Time constant 1    = {:7.3f}".format(res.x[2]))
-    print("Ambient PV         = {:7.3f} in PV units".format(res.x[3]))
-    print("Dead time          = {:7.3f}".format(res.x[4]))
-    print("Time units are the same as provided in input file")
-    # calculate the controller ISA PID parameters
-    tc = max(0.1*max(t0,t1),0.8*dt)     # closed loop time constant
-    kc = (t0+t1)/(k*(tc+dt))            # controller gain %CO/error
-    ti = t0+t1                          # integrator time constant
-    td = t0*t1/(t0+t1)                  # derivative time constant
-    print("The closed loop time constant = {:7.3f}".format(tc))
-    print("The controller gain           = {:7.3f} %CO/unit of error"
-          .format(kc))
-    print("The integrator time constant  = {:7.3f}".format(ti))
-    print("The derivative time constant  = {:7.3f}".format(td))
+    print("RMS error          = {:7.3f}".format(sqrt(fun/len(aTime))))
+    print_sopdt(x)
+
 
 if "__main__" == __name__:
     """
@@ -149,7 +407,10 @@ Usage:
     SysID_SOPDT.py          \\
     [--path=Hotrod.txt]     \\
     [--method=Nelder-Mead]  \\
-    [--pv0=3.757,170.959,41.070,77.846,21.248]
+    [--pv0=3.757,170.959,41.070,77.846,21.248] \\
+    [--hold=foh|zoh]        \\
+    [--odeint_model]        \\
+    [--multi_start=N [--bounds=lo:hi,lo:hi,lo:hi,lo:hi,lo:hi] [--processes=0] [--seed=S]]
 
   OR
 
@@ -8,6 +8,7 @@ Delta Computer Systems, Inc.
 
 import numpy as np
 import csv
+import itertools
 
 
 def readCSV(path):
@@ -39,6 +40,68 @@ def readCSV(path):
     return [aTime, aControl, aAct]      # return a list of three np.arrays
 
 
+def csv_layout(path):
+    """ return the delimiter (None for whitespace) and the number of
+        header lines (0 or 1) of the CSV file designated by the path,
+        from its first line """
+    with open(path) as csvfile:
+        first = csvfile.readline()
+    delimiter = '\t' if '\t' in first else (',' if ',' in first else None)
+    try:
+        [float(tok) for tok in first.split(delimiter)]
+        return delimiter, 0
+    except ValueError:
+        return delimiter, 1
+
+
+def count_lines(path, blocksize=1 << 20):
+    """ count lines in file designated by the path, without decoding """
+    n, last = 0, b'\n'
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(blocksize), b''):
+            n, last = n + block.count(b'\n'), block[-1:]
+    return n + (last != b'\n')
+
+
+def iter_readCSV(path, columns=(0, 1, 2), chunk_rows=1 << 20):
+    """ Generator:  read the same files as readCSV, chunk_rows rows at a
+        time, and yield a list of one np.array per selected column for
+        each chunk.  Memory in use is bounded by the chunk size """
+    delimiter, skip = csv_layout(path)
+    with open(path) as csvfile:
+        for _ in range(skip): next(csvfile)
+        while True:
+            lines = list(itertools.islice(csvfile, chunk_rows))
+            if not lines: break
+            arr = np.loadtxt(lines, delimiter=delimiter, usecols=columns,
+                             ndmin=2, dtype=np.float64)
+            if len(arr): yield [arr[:,i] for i in range(len(columns))]
+
+
+def readCSV_fast(path, columns=(0, 1, 2), chunk_rows=None):
+    """ Faster replacement for readCSV:  same files, same result
+
+        The layout is found from the first line only, and the file is
+        parsed in one bulk pass by np.loadtxt, with no Python lists.
+        columns selects the time, control and actual columns of wider
+        files.  With chunk_rows, for files with millions of rows, the
+        rows are counted first and parsed chunk_rows at a time straight
+        into one preallocated array, so no more than one chunk of text
+        and the result are in memory at once """
+    if not chunk_rows:
+        delimiter, skip = csv_layout(path)
+        arr = np.loadtxt(path, delimiter=delimiter, skiprows=skip,
+                         usecols=columns, ndmin=2, dtype=np.float64)
+        return [np.ascontiguousarray(arr[:,i]) for i in range(len(columns))]
+
+    out = np.empty((len(columns), count_lines(path)))
+    n = 0
+    for chunk in iter_readCSV(path, columns=columns, chunk_rows=chunk_rows):
+        out[:,n:n+len(chunk[0])] = chunk
+        n += len(chunk[0])
+    return list(out[:,:n])
+
+
 if __name__ == "__main__":
     """ Run this file To test the readCSV program by itself.
         The path must point to the file you want to read.
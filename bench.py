@@ -0,0 +1,263 @@
+"""
+Benchmarks of the simulation and identification hot paths
+
+Each benchmark runs on fixed inputs from this repository; its best wall
+time over --repeat runs gives throughput in its own units, and one more
+run under tracemalloc gives peak memory.  The report is JSON; compared
+to a baseline report, throughput lower, or peak memory higher, than the
+tolerance allows are flagged as regressions, and the exit status is 1.
+
+Benchmarks:
+
+  pid_control        - PID.control, per call
+  pid_replay         - PID.replay, per update
+  model_with_pid_1d  - CET.model_with_pid, one day (simulated s per s)
+  model_with_pid_30d - CET.model_with_pid, 30 days
+  model_data         - CET.model_data replay of recorded CVs
+  read_XLSX          - read_XLSX of Tank_20 workbook, uncached (rows/s)
+  readCSV            - SmithPredictor readCSV of Tank_data_dbacklash.txt
+  readCSV_fast       - same, readCSV_fast
+  t0p2               - one SysID_SOPDT objective evaluation on same data
+  pid_screen         - pid_screen.screen of 6000 PID tunings, one day each
+                       (combinations/s)
+  startup            - new pv_predict.py process to first PID result
+                       (--no-model-data, one simulated hour), per run
+
+Benchmarks listed in targets must also take no more than their target
+seconds per unit of work (e.g. startup, for sweep drivers that start
+many short processes); one that takes longer is flagged as a regression
+whether or not there is a baseline.
+
+Usage:
+
+  python bench.py [--only=NAME,NAME] [--repeat=3] [--json=report.json] \\
+                  [--baseline=baseline.json] [--save-baseline=baseline.json] \\
+                  [--tolerance=0.20] [--mem-tolerance=0.20] [--startup-target=0.25]
+
+"""
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+
+os.environ.setdefault('MPLBACKEND','Agg')
+
+import pid
+import pv_predict as pvp
+import pid_screen
+import read_interleaved_XLSX as riX
+
+here = os.path.dirname(os.path.abspath(__file__))
+smith_dir = os.path.join(here,'SmithPredictor')
+xlsx_path = os.path.join(here,pvp.CET.default_pathv[0])
+tsv_path = os.path.join(smith_dir,'Tank_data_dbacklash.txt')
+tsv_pv0 = [-.074,6085.,2922.,12.25,0.033]
+
+### Maximum seconds per unit of work, by benchmark name
+targets = dict(startup=0.25)
+
+
+########################################################################
+### Benchmark setups:  each returns (run,unit), where run() does the
+### timed work and returns the amount of work done, in units
+def bench_pid_control():
+  N = 100000
+  pvs = 12.0 + np.sin(np.arange(N) * 0.01)
+  def run():
+    ctlpid = pid.PID(5.0,8.0,1.5,CVlast=0.0)
+    for pv in pvs: ctlpid.control(pv,12.0)
+    return N
+  return run,'calls'
+
+
+def bench_pid_replay():
+  N = 10000000
+  pvs = 12.0 + np.sin(np.arange(N) * 0.01)
+  def run():
+    pid.PID(5.0,8.0,1.5,CVlast=0.0).replay(pvs,12.0)
+    return N
+  return run,'updates'
+
+
+def bench_model_with_pid(days):
+  cet = pvp.CET(xlsx_path,**{'no-plot':True})
+  cet.pid_duration = days * 86400.0
+  def run():
+    ATs = cet.model_with_pid(dict(),do_plot=False)[0]
+    return ATs[-1] - ATs[0]
+  return run,'simulated s'
+
+
+def bench_model_data():
+  cet = pvp.CET(xlsx_path,**{'no-plot':True})
+  def run():
+    pATs = cet.model_data(do_plot=False)[0]
+    return pATs[-1] - pATs[0]
+  return run,'simulated s'
+
+
+def bench_read_XLSX():
+  def run(): return len(riX.read_XLSX(xlsx_path)[0])
+  return run,'rows'
+
+
+def bench_readCSV(fast):
+  sys.path.insert(0,smith_dir)
+  import readCSV
+  reader = fast and readCSV.readCSV_fast or readCSV.readCSV
+  def run(): return len(reader(tsv_path)[0])
+  return run,'rows'
+
+
+def bench_t0p2():
+  sys.path.insert(0,smith_dir)
+  import SysID_SOPDT as sysid
+  import readCSV
+  aTime,aCO,aPV = readCSV.readCSV_fast(tsv_path)
+  model = sysid.make_model(aTime,aCO)
+  def run():
+    sysid.t0p2(tsv_pv0,aTime,aPV,model,verbose=False)
+    return 1
+  return run,'evaluations'
+
+
+def bench_pid_screen():
+  cet = pvp.CET(**{'no-model-data':True,'no-plot':True})
+  grids = [np.arange(1.0,101.0),np.arange(2.0,122.0,2.0),[0.0],[45.0]]
+  def run():
+    return len(pid_screen.screen(cet,grids)['Kc'])
+  return run,'combinations'
+
+
+def bench_startup():
+  cmd = [sys.executable,os.path.join(here,'pv_predict.py')
+        ,'--no-model-data','--no-plot','--pid-duration=3600']
+  def run():
+    subprocess.run(cmd,check=True,stdout=subprocess.DEVNULL)
+    return 1
+  return run,'runs'
+
+
+benchmarks = (('pid_control',bench_pid_control,)
+             ,('pid_replay',bench_pid_replay,)
+             ,('model_with_pid_1d',lambda:bench_model_with_pid(1),)
+             ,('model_with_pid_30d',lambda:bench_model_with_pid(30),)
+             ,('model_data',bench_model_data,)
+             ,('read_XLSX',bench_read_XLSX,)
+             ,('readCSV',lambda:bench_readCSV(False),)
+             ,('readCSV_fast',lambda:bench_readCSV(True),)
+             ,('t0p2',bench_t0p2,)
+             ,('pid_screen',bench_pid_screen,)
+             ,('startup',bench_startup,)
+             ,)
+
+
+########################################################################
+def run_benchmark(setup,repeat=3):
+  """Set up and time one benchmark; return its report entry"""
+  run,unit = setup()
+  times = list()
+  for i in range(repeat):
+    t0 = time.perf_counter()
+    work = run()
+    times.append(time.perf_counter() - t0)
+
+  ### Peak memory from a separate run, as tracing slows the work down
+  tracemalloc.start()
+  try:
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+  best = min(times)
+  return dict(unit=unit
+             ,work=float(work)
+             ,seconds=best
+             ,median_seconds=float(np.median(times))
+             ,throughput=float(work) / best
+             ,peak_bytes=int(peak)
+             )
+
+
+def run_all(names=None,repeat=3,fout=sys.stderr):
+  """Run selected benchmarks (all if names is None); return report dict"""
+  report = dict(meta=dict(python=platform.python_version()
+                         ,numpy=np.__version__
+                         ,machine=platform.machine()
+                         ,processor=platform.processor()
+                         ,cpus=os.cpu_count()
+                         ,date=time.strftime('%Y-%m-%dT%H:%M:%S')
+                         )
+               ,benchmarks=dict()
+               )
+  for name,setup in benchmarks:
+    if not (None is names or name in names): continue
+    fout.write('{0} ...'.format(name))
+    fout.flush()
+    entry = report['benchmarks'][name] = run_benchmark(setup,repeat)
+    fout.write(' {0:.4g} {1}/s, {2:.4g}s, peak {3:.1f}MB\n'.format(
+               entry['throughput'],entry['unit'],entry['seconds']
+              ,entry['peak_bytes'] / 1e6))
+  return report
+
+
+def compare(report,baseline,tolerance=0.20,mem_tolerance=0.20):
+  """
+  Return list of (name,quantity,ratio,) regressions of report vs. baseline;
+  ratio is new/old throughput, or new/old peak memory
+
+  """
+  regressions = list()
+  old = baseline['benchmarks']
+  for name,entry in report['benchmarks'].items():
+    if not (name in old): continue
+    ratio = entry['throughput'] / old[name]['throughput']
+    entry['throughput_ratio'] = ratio
+    if ratio < (1.0 - tolerance): regressions.append((name,'throughput',ratio,))
+    if old[name]['peak_bytes']:
+      ratio = entry['peak_bytes'] / float(old[name]['peak_bytes'])
+      entry['peak_ratio'] = ratio
+      if ratio > (1.0 + mem_tolerance): regressions.append((name,'peak memory',ratio,))
+  return regressions
+
+
+def check_targets(report,targets=targets):
+  """Return list of (name,quantity,ratio,) of benchmarks slower than targets"""
+  regressions = list()
+  for name,entry in report['benchmarks'].items():
+    if not (name in targets): continue
+    entry['target_seconds'] = targets[name]
+    ratio = (entry['seconds'] / entry['work']) / targets[name]
+    if ratio > 1.0: regressions.append((name,'seconds over target',ratio,))
+  return regressions
+
+
+if "__main__" == __name__:
+  args,keywords = pvp.process_args(sys.argv[1:])
+  names = 'only' in keywords and keywords['only'].split(',') or None
+  report = run_all(names,int(keywords.get('repeat',3)))
+
+  regressions = check_targets(report,dict(targets,startup=float(keywords.get('startup-target',targets['startup']))))
+  if 'baseline' in keywords:
+    with open(keywords['baseline']) as fin: baseline = json.load(fin)
+    regressions += compare(report,baseline
+                          ,float(keywords.get('tolerance',0.20))
+                          ,float(keywords.get('mem-tolerance',0.20))
+                          )
+  report['regressions'] = [dict(name=name,quantity=quantity,ratio=ratio)
+                           for name,quantity,ratio in regressions
+                          ]
+  for name,quantity,ratio in regressions:
+    sys.stderr.write('REGRESSION:  {0} {1} ratio {2:.3f}\n'.format(name,quantity,ratio))
+
+  for key in ('json','save-baseline',):
+    if key in keywords:
+      with open(keywords[key],'w') as fout: json.dump(report,fout,indent=2)
+  if not ('json' in keywords): json.dump(report,sys.stdout,indent=2)
+
+  sys.exit(regressions and 1 or 0)
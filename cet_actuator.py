@@ -0,0 +1,225 @@
+"""
+Valve actuator pipeline for the CET model (see pv_predict.py)
+
+The PID CV reaches the tank through a chain of stages:  quantization of
+the CV to whole percent, valve position backlash, optional compensation
+pulses (fix-backlash), and finally the cooling curve, which converts the
+valve position to CVscalar, the per-timestep temperature change.
+
+Every stage works on a scalar stream, one value per .step() call, or on
+a whole array at once with .apply(); both return the stage output and an
+event flag (e.g. backlash held the valve), ORed with the flags of the
+stages before it.  Stateful stages keep their state between calls, and
+.reset(position) restarts them as if the valve were at position.
+
+Stages that act on the model time step timeline, such as compensation
+pulses, return from .transients() the (position, model steps) segments
+to run before the stage output takes effect; only the scalar path of
+Actuator runs them.  New valve behaviours are new Stage subclasses, put
+in the list passed to Actuator, so the simulation loops need no change.
+
+Valve positions after quantization are whole percentages, so the cooling
+curve is a table of its values at 0 to 100%, calculated once per
+parameter set; other positions fall back to the curve function.
+
+"""
+import numpy as np
+import read_interleaved_XLSX as riX
+
+class Stage:
+  """
+  Actuator stage that passes values through unchanged
+
+  Subclasses override .step(), and .apply() where an array equivalent
+  is faster than the default of calling .step() once per element
+
+  """
+  def reset(self,position=None):
+    """Restart stage with valve at position (None for unknown)"""
+    pass
+
+  def step(self,x,event=False):
+    """Return output and event flag for one input value"""
+    return x,event
+
+  def apply(self,xs,events=None):
+    """Return output and event flag arrays for array of input values"""
+    xs = np.asarray(xs,dtype=np.float64)
+    ys,flags = np.empty(len(xs)),np.zeros(len(xs),dtype=bool)
+    if None is events: events = flags.copy()
+    for i,x in enumerate(xs): ys[i],flags[i] = self.step(x,events[i])
+    return ys,flags
+
+  def transients(self):
+    """Return (position,nsteps) segments to run before output holds"""
+    return ()
+
+
+class Quantize(Stage):
+  """Round CV to multiple of resolution (default whole percent)"""
+  def __init__(self,resolution=1.0):
+    self.resolution = float(resolution)
+
+  def step(self,x,event=False):
+    if 1.0 == self.resolution: return round(x,0),event
+    return round(x / self.resolution,0) * self.resolution,event
+
+  def apply(self,xs,events=None):
+    xs = np.asarray(xs,dtype=np.float64)
+    if None is events: events = np.zeros(len(xs),dtype=bool)
+    if 1.0 == self.resolution: return np.round(xs,0),events
+    return np.round(xs / self.resolution,0) * self.resolution,events
+
+
+class Backlash(Stage):
+  """
+  Valve position backlash:  the valve does not close below its last
+  position unless the input is 0 or less, when it closes fully; event
+  flag is set when the valve is held above a positive input
+
+  """
+  def __init__(self,position=None):
+    self.reset(position)
+
+  def reset(self,position=None):
+    self.position = (None is position) and -1e32 or float(position)
+
+  def step(self,x,event=False):
+    if x >= self.position: self.position = x
+    elif x <= 0.0        : self.position = 0.0
+    else                 : return self.position,True
+    return self.position,event
+
+  def apply(self,xs,events=None):
+    """
+    Backlash is a running maximum of the inputs that restarts at 0
+    wherever an input is 0 or less, so it is a segmented cumulative max
+
+    """
+    xs = np.asarray(xs,dtype=np.float64)
+    if None is events: events = np.zeros(len(xs),dtype=bool)
+    if not len(xs): return xs.copy(),events
+    if np.any(xs[1:] < 0.0):
+      ### Negative inputs restart at either 0 or the input itself,
+      ### depending on the previous position; use the sequential rule
+      return Stage.apply(self,xs,events)
+    first,event0 = self.step(xs[0],events[0])
+    starts = xs <= 0.0
+    starts[0] = True
+    values = np.where(starts,0.0,xs)
+    values[0] = first
+    positions = riX.segmented_cummax(values,starts)
+    flags = np.bitwise_or(events,np.bitwise_and(xs > 0.0,positions != xs))
+    flags[0] = event0
+    self.position = positions[-1]
+    return positions,flags
+
+
+class CompensationPulse(Stage):
+  """
+  Backlash compensation (fix-backlash):  on an event from the stages
+  before it, drive the valve to position for nsteps model time steps
+  before the new position takes effect
+
+  """
+  def __init__(self,nsteps=2,position=0.0):
+    self.nsteps,self.position = int(nsteps),float(position)
+    self.pending = False
+
+  def reset(self,position=None):
+    self.pending = False
+
+  def step(self,x,event=False):
+    self.pending = event
+    return x,event
+
+  def apply(self,xs,events=None):
+    """Pulses are on the model time step timeline; arrays pass through"""
+    xs = np.asarray(xs,dtype=np.float64)
+    if None is events: events = np.zeros(len(xs),dtype=bool)
+    return xs,events
+
+  def transients(self):
+    if not self.pending: return ()
+    self.pending = False
+    return ((self.position,self.nsteps,),)
+
+
+class CoolingCurve(Stage):
+  """
+  Valve position to CVscalar, by table lookup at whole percentages
+  lo:hi, calculated once from function func; other positions call func
+
+  """
+  def __init__(self,func,lo=0,hi=100):
+    self.func,self.lo,self.hi = func,int(lo),int(hi)
+    self.table = np.array([func(float(position)) for position in range(self.lo,self.hi+1)])
+    self.scalars = self.table.tolist()
+
+  def step(self,x,event=False):
+    i = int(x)
+    if i == x and self.lo <= i <= self.hi: return self.scalars[i-self.lo],event
+    return self.func(x),event
+
+  def apply(self,xs,events=None):
+    xs = np.asarray(xs,dtype=np.float64)
+    if None is events: events = np.zeros(len(xs),dtype=bool)
+    inside = np.bitwise_and(xs >= self.lo,xs <= self.hi)
+    inside[inside] = np.mod(xs[inside],1.0) == 0.0
+    ys = self.table[np.where(inside,xs - self.lo,0.0).astype(np.intp)]
+    if not np.all(inside):
+      ### Evaluate func once per distinct position outside the table
+      uniqs,inverse = np.unique(xs[~inside],return_inverse=True)
+      ys[~inside] = np.array([self.func(x) for x in uniqs])[inverse]
+    return ys,events
+
+
+class Actuator:
+  """
+  Chain of valve position stages, followed by cooling curve
+
+  .command(xCV) passes one PID CV through the stages; .apply(xCVs) passes
+  a whole array of CVs through them, without transients
+
+  """
+  def __init__(self,stages,curve):
+    self.stages,self.curve = list(stages),curve
+    self.reset()
+
+  def reset(self,position=None):
+    """Restart all stages with valve at position (None for unknown)"""
+    for stage in self.stages: stage.reset(position)
+    self.position = position
+
+  def command(self,xCV):
+    """
+    Pass xCV through stages; return (blCV, rCV, xCV, CVscalar, event,
+    transients), as CET.xCV_to_CV plus transients:  blCV and rCV are the
+    outputs of the last and first stages; transients is a list of
+    (CVscalar,nsteps) segments to run, in order, before CVscalar holds
+
+    After a transient, the stages before the one that asked for it are
+    restarted from the transient position, and xCV passed through them
+    again, so CVscalar and .position are those after the transients
+
+    """
+    x,event,transients,outputs = xCV,False,list(),list()
+    for i,stage in enumerate(self.stages):
+      x,event = stage.step(x,event)
+      outputs.append(x)
+      for position,nsteps in stage.transients():
+        transients.append((self.curve.step(position)[0],nsteps,))
+        x = xCV
+        for upstream in self.stages[:i]:
+          upstream.reset(position)
+          x,ignore = upstream.step(x)
+    self.position = x
+    blCV,rCV = (outputs[-1],outputs[0],) if outputs else (xCV,xCV,)
+    return blCV,rCV,xCV,self.curve.step(x)[0],event,transients
+
+  def apply(self,xCVs):
+    """Array equivalent of .command over xCVs; return positions, event flags and CVscalars"""
+    xs,events = np.asarray(xCVs,dtype=np.float64),None
+    for stage in self.stages: xs,events = stage.apply(xs,events)
+    if len(xs): self.position = xs[-1]
+    return xs,events,self.curve.apply(xs)[0]
@@ -0,0 +1,306 @@
+"""
+Monte Carlo ensemble of CET closed-loop PID simulations (see pv_predict.py)
+
+Samples many plant parameter sets from given distributions, and runs the
+closed loop of CET.model_with_pid for all of them at once, with the same
+PID tuning:  the members are elements of arrays, their PID loops are one
+pid.PIDBank, and between PID updates each member's plant advances by
+the closed form of CET.model_n_timesteps, so there is one Python
+iteration per PID update for the whole ensemble.
+
+Reports percentiles, across members, of PV deviation from setpoint and
+of valve position at each PID update (bands), and of per-member metrics:
+IAE, ISE, Overshoot and Settling of PV deviation (as in pid_sweep.py),
+and Reversals, Backlash events, fix-backlash Pulses and total valve
+Travel for valve activity.
+
+Usage:
+
+  python cet_ensemble.py [--members=10000] [--seed=S] [--fix-backlash] \\
+                         [--Ke-per-h=normal:0.12:0.02] [--kPV=uniform:0.995:0.998] \\
+                         [--CVe=triangular:3:3.6:4.5] [--CVe0=0.9] \\
+                         [--CVe0-Ke-frac=1] [--CVexponent=lognormal:0.85:0.1] \\
+                         [--pid-Kc=50] [--pid-Ti=60] [--pid-Td=0] \\
+                         [--bands=bands.tsv] [--no-plot] \\
+                         [other pv_predict.py model arguments]
+
+  Distributions of plant parameters:
+
+    VALUE                       - fixed
+    normal:MEAN:SD
+    uniform:LO:HI
+    triangular:LO:MODE:HI
+    lognormal:MEDIAN:SIGMA      - SIGMA of natural log
+
+  Unspecified plant parameters are fixed at their CET values
+
+"""
+import sys
+import math
+import numpy as np
+import pid
+import pv_predict as pvp
+
+### Sampled plant parameters:  CET keyword, CET attribute
+param_keys = pvp.plant_keys
+
+default_percentiles = (5,25,50,75,95,)
+
+### Distribution names, and functions of (rng,parameters,size)
+distributions = dict(normal=lambda rng,p,M: rng.normal(p[0],p[1],M)
+                    ,uniform=lambda rng,p,M: rng.uniform(p[0],p[1],M)
+                    ,triangular=lambda rng,p,M: rng.triangular(p[0],p[1],p[2],M)
+                    ,lognormal=lambda rng,p,M: p[0] * rng.lognormal(0.0,p[1],M)
+                    )
+
+def sample(val,rng,members):
+  """Draw members samples of distribution 'NAME:P0:P1...', or fixed value"""
+  toks = str(val).split(':')
+  if 1 == len(toks): return np.full(members,float(toks[0]))
+  assert toks[0] in distributions,'Unknown distribution [{0}]'.format(toks[0])
+  return distributions[toks[0]](rng,list(map(float,toks[1:])),members)
+
+
+def sample_parameters(cet,keywords,members,seed=None):
+  """Return dict of CET attribute:array of members samples"""
+  rng = np.random.default_rng(seed)
+  return dict([(attr,sample(keywords.get(key,getattr(cet,attr)),rng,members),)
+               for key,attr in param_keys
+              ])
+
+
+class Ensemble:
+  """
+  Closed-loop PID simulation of CET plant ensemble
+
+  cet supplies PID tuning, setpoint, duration and model time step; params
+  is a dict of per-member CET plant parameter arrays, all the same length
+
+  """
+  def __init__(self,cet,params):
+    self.cet = cet
+    for key,attr in param_keys: setattr(self,attr,np.asarray(params[attr],dtype=np.float64))
+    self.members = len(self.Ke_per_h)
+
+    ### Per-timestep parameters, as in CET.calculate_per_timestep_parameters
+    self.Ke = self.Ke_per_h * cet.model_time_step / 3600.0
+    self.kPV_step = self.kPV**cet.model_time_step
+
+    ### Backlashed valve positions are whole percentages in [0:100], so
+    ### CVscalars are looked up, per member, in table of those positions
+    self.CVscalar_table = self.calculate_CVscalars(np.arange(101.0)[:,np.newaxis])
+    self.imembers = np.arange(self.members)
+    self.nstep_coefficients = dict()
+
+  def calculate_CVscalars(self,CVs):
+    """Array equivalent of CET.calculate_CVscalar, one CV per member"""
+    with np.errstate(invalid='ignore'):
+      frac = np.maximum(CVs - self.CVe0,0.0) / (self.CVe - self.CVe0)
+      return np.where(CVs > self.CVe0
+                     ,self.Ke * (1.0 - (self.CVe_Ke_frac * frac**self.CVexponent))
+                     ,self.Ke)
+
+  def lookup_CVscalars(self,blCVs):
+    """CVscalars of whole-percentage valve positions, one per member"""
+    return self.CVscalar_table[blCVs.astype(np.intp),self.imembers]
+
+  def model_n_timesteps(self,Tt,PV,CVscalars,nsteps):
+    """
+    Array equivalent of CET.model_n_timesteps, one CVscalar per member
+
+    The PV-Tt fixed point is linear in CVscalar, so the closed form is
+    PV-Tt <- (PV-Tt)*kPV_step**nsteps + c0 - c1*CVscalar, with per-member
+    coefficients calculated once per nsteps
+
+    """
+    if not (nsteps in self.nstep_coefficients):
+      unity = self.kPV_step == 1.0
+      kPV_step = np.where(unity,0.5,self.kPV_step)
+      kn = np.where(unity,1.0,kPV_step**nsteps)
+      c0 = np.where(unity,nsteps * self.Ke,self.Ke * (1.0 - kn) / (1.0 - kPV_step))
+      c1 = np.where(unity,float(nsteps),kPV_step * (1.0 - kn) / (1.0 - kPV_step))
+      self.nstep_coefficients[nsteps] = kn,c0,c1
+    kn,c0,c1 = self.nstep_coefficients[nsteps]
+    retTt = Tt + (nsteps * CVscalars)
+    retPV = retTt + ((PV - Tt) * kn) + c0 - (c1 * CVscalars)
+    return retTt,retPV
+
+  def run(self,fix_backlash=False,percentiles=default_percentiles,settle_band=0.05):
+    """
+    Simulate ensemble; return PID update times, percentile bands of PV
+    deviation and of valve position at those times, shape (updates,
+    percentiles), and dict of per-member metric arrays
+
+    Bands and metrics are accumulated one PID update at a time:  member
+    state and metrics take memory per member, but not per update, and
+    bands take memory per update, (updates,percentiles), but not per
+    member, so memory does not grow with members times duration
+
+    """
+    cet,M = self.cet,self.members
+    step = cet.model_time_step
+    nsteps = int(math.ceil(cet.pid_updatetime / step))
+    L = int(math.ceil(cet.pid_duration / cet.pid_updatetime))
+    dt = nsteps * step
+    setpoint = cet.pid_setpoint
+
+    ### Initial state, as in CET.model_with_pid
+    xPV,xTt = np.full(M,11.80),np.full(M,11.80)
+    blCV = np.full(M,-1e32)
+    bank = pid.PIDBank(M)
+    for i in range(M):
+      bank.add_loop(cet.pid_Kc,cet.pid_Ti,cet.pid_Td
+                   ,CVlast=0.0
+                   ,Updatetime=cet.pid_updatetime
+                   ,Deadband=cet.pid_deadband
+                   )
+    zeroCVscalars = self.CVscalar_table[0]
+    setpoints = np.full(M,setpoint)
+
+    ### Bands, and running metric accumulators
+    ATs = np.arange(L) * dt
+    devbands,valvebands = np.zeros((L,len(percentiles))),np.zeros((L,len(percentiles)))
+    IAE,ISE,peak = np.zeros(M),np.zeros(M),np.full(M,-np.inf)
+    lastout = np.full(M,-1)
+    lastmove,reversals = np.zeros(M),np.zeros(M,dtype=np.int64)
+    nbacklash,npulses,travel = np.zeros(M,dtype=np.int64),np.zeros(M,dtype=np.int64),np.zeros(M)
+    sign = None
+
+    for i in range(L):
+      rPV = np.round(xPV,2)
+      xCV = bank.control(rPV,setpoints)
+
+      ### Valve backlash, as in CET.xCV_to_CV
+      rCV = np.round(xCV,0)
+      up,closed = rCV >= blCV,rCV <= 0.0
+      backlash = ~(up | closed)
+      newblCV = np.where(up,rCV,np.where(closed,0.0,blCV))
+
+      ### Metrics of this update
+      err = rPV - setpoint
+      if None is sign: sign = np.where(rPV > setpoint,-1.0,1.0)
+      IAE += np.abs(err) * dt
+      ISE += err * err * dt
+      peak = np.maximum(peak,sign * err)
+      lastout[np.abs(err) > settle_band] = i
+      if i:
+        move = np.sign(newblCV - recblCV)
+        moving = move != 0.0
+        reversals += moving & (lastmove != 0.0) & (move != lastmove)
+        lastmove = np.where(moving,move,lastmove)
+        travel += np.abs(newblCV - recblCV)
+      nbacklash += backlash
+      blCV = recblCV = newblCV
+
+      devbands[i],valvebands[i] = np.percentile(np.vstack((err,blCV,)),percentiles,axis=1).T
+
+      ### Advance plants to next PID update; fix-backlash members spend
+      ### the first two steps at zero CV, then the valve re-opens to the
+      ### rounded PID CV
+      CVscalars = self.lookup_CVscalars(blCV)
+      if fix_backlash and backlash.any():
+        npulses += backlash
+        zsteps = min(2,nsteps)
+        xTt,xPV = self.model_n_timesteps(xTt,xPV,np.where(backlash,zeroCVscalars,CVscalars),zsteps)
+        if nsteps > zsteps:
+          blCV = np.where(backlash,np.maximum(rCV,0.0),blCV)
+          CVscalars = np.where(backlash,self.lookup_CVscalars(blCV),CVscalars)
+          xTt,xPV = self.model_n_timesteps(xTt,xPV,CVscalars,nsteps-zsteps)
+        else:
+          blCV = np.where(backlash,0.0,blCV)
+      else:
+        xTt,xPV = self.model_n_timesteps(xTt,xPV,CVscalars,nsteps)
+
+    settling = np.where(lastout < 0,0.0
+                       ,np.where(lastout + 1 < L,(lastout + 1) * dt,np.inf))
+    metrics = dict(IAE=IAE
+                  ,ISE=ISE
+                  ,Overshoot=np.maximum(peak,0.0)
+                  ,Settling=settling
+                  ,Reversals=reversals
+                  ,Backlash=nbacklash
+                  ,Pulses=npulses
+                  ,Travel=travel
+                  )
+    return ATs,devbands,valvebands,metrics
+
+
+def percentiles_with_inf(values,percentiles=default_percentiles):
+  """
+  np.percentile (linear interpolation) of values that may include inf,
+  e.g. Settling of members that never settle:  inf where interpolation
+  reaches an inf value, instead of the NaN of inf - inf
+
+  """
+  values = np.sort(np.asarray(values,dtype=np.float64))
+  positions = np.asarray(percentiles,dtype=np.float64) * (len(values) - 1) / 100.0
+  nfinite = int(np.isfinite(values).sum())
+  result = np.full(len(positions),np.inf)
+  inside = np.ceil(positions) < nfinite
+  if inside.any(): result[inside] = np.interp(positions[inside],np.arange(nfinite),values[:nfinite])
+  return result
+
+
+def print_summary(metrics,percentiles=default_percentiles,fout=sys.stdout):
+  """Write table of percentiles across members of each metric"""
+  header = ['Metric'] + ['p{0:g}'.format(q) for q in percentiles]
+  lines = [header]
+  for name,values in metrics.items():
+    lines.append([name] + ['{0:.4g}'.format(v) for v in percentiles_with_inf(values,percentiles)])
+  widths = [max([len(line[i]) for line in lines]) for i in range(len(header))]
+  for line in lines:
+    fout.write('  '.join([tok.rjust(width) for tok,width in zip(line,widths)])+'\n')
+
+
+def write_bands(path,ATs,devbands,valvebands,percentiles=default_percentiles):
+  """Write bands as TSV, one row per PID update"""
+  header = ['Time'] + ['PVdev_p{0:g}'.format(q) for q in percentiles] + ['Valve_p{0:g}'.format(q) for q in percentiles]
+  with open(path,'w') as fout:
+    fout.write('\t'.join(header)+'\n')
+    np.savetxt(fout,np.column_stack((ATs,devbands,valvebands,)),fmt='%.6g',delimiter='\t')
+
+
+def plot_bands(ATs,devbands,valvebands,title,percentiles=default_percentiles):
+  """Fan chart of bands; percentiles are assumed symmetric about median"""
+  import matplotlib.pyplot as plt
+
+  fig,(pvplt,cvplt) = plt.subplots(nrows=2,ncols=1
+                                  ,sharex=True
+                                  ,gridspec_kw=dict(height_ratios=[3,1])
+                                  )
+  n = len(percentiles)
+  for xvplt,bands,ylabel in ((pvplt,devbands,'PV - SP, degC',),(cvplt,valvebands,'Valve, %',),):
+    for j in range(n//2):
+      xvplt.fill_between(ATs,bands[:,j],bands[:,n-1-j]
+                        ,alpha=0.25
+                        ,color='C0'
+                        ,label='p{0:g}-p{1:g}'.format(percentiles[j],percentiles[n-1-j])
+                        )
+    xvplt.plot(ATs,bands[:,n//2],color='C1',linewidth=0.5,label='p{0:g}'.format(percentiles[n//2]))
+    xvplt.set_ylabel(ylabel)
+    xvplt.legend(loc='best')
+  pvplt.set_title(title)
+  cvplt.set_xlabel('Time, s')
+  plt.show()
+
+
+if "__main__" == __name__:
+  args,keywords = pvp.process_args(sys.argv[1:])
+  cet = pvp.CET(*args,**dict([(k,v,) for k,v in keywords.items()
+                               if not (k in [key for key,attr in param_keys])
+                              ]))
+  members = int(keywords.get('members',10000))
+  params = sample_parameters(cet,keywords,members
+                            ,int(keywords['seed']) if 'seed' in keywords else None
+                            )
+  ensemble = Ensemble(cet,params)
+  ATs,devbands,valvebands,metrics = ensemble.run('fix-backlash' in keywords
+                                                ,settle_band=float(keywords.get('settle-band',0.05))
+                                                )
+  print_summary(metrics)
+  if 'bands' in keywords: write_bands(keywords['bands'],ATs,devbands,valvebands)
+  if cet.do_plot:
+    plot_bands(ATs,devbands,valvebands
+              ,'{0} members Kc={1} Ti={2}min Td={3}min Update={4}s{5}'.format(
+               members,cet.pid_Kc,cet.pid_Ti,cet.pid_Td,cet.pid_updatetime
+              ,'fix-backlash' in keywords and ' fix-backlash' or ''))
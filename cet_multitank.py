@@ -0,0 +1,243 @@
+"""
+Many CET tanks cooled by one shared glycol chiller (see pv_predict.py)
+
+Each tank is the CET heat-balance model with its own plant parameters,
+PID loop and valve backlash, as one member of a cet_ensemble.Ensemble;
+all tank states are arrays, their PID loops are one pid.PIDBank, and
+each model time step is a fixed number of array operations whatever the
+number of tanks.
+
+The tanks are coupled, one model time step at a time, through the glycol
+supply temperature Ts.  CVscalar of each valve position is the tank's
+cooling at the design supply temperature; a tank at PV receives the
+fraction (PV - Ts) / (PV - design Ts) of it.  Glycol absorbs the heat
+removed from all tanks; the chiller removes up to its capacity, pulling
+Ts back to the design temperature, and the rest warms the glycol loop,
+of thermal mass --glycol-mass tank equivalents per tank.  So when many
+valves open together, Ts rises and every tank gets less cooling.  With
+capacity to spare, Ts stays at design and each tank follows the single
+tank model of CET.model_with_pid.
+
+Capacity is in degrees per hour of one tank (tank equivalents), per
+tank; the default tank needs 0.12 deg/h to hold temperature, and its
+valve fully open cools 2.4 deg/h at design supply temperature.
+
+Reports percentiles, across tanks, of per-tank metrics:  IAE, ISE,
+Overshoot and Settling (as cet_ensemble.py), Backlash events, and
+Unmet, total cooling lost to supply temperature above design, deg; and
+peak supply temperature and time at full chiller capacity.
+
+Usage:
+
+  python cet_multitank.py [--tanks=200] [--seed=S] [--fix-backlash] \\
+                          [--chiller-capacity=0.5] [--supply-temp=-2] \\
+                          [--glycol-mass=0.1] [--init-PV=uniform:11.8:14] \\
+                          [--Ke-per-h=normal:0.12:0.02] [...] \\
+                          [--pid-Kc=50] [--pid-Ti=60] [--pid-Td=0] \\
+                          [--no-plot] [other pv_predict.py model arguments]
+
+  Plant parameters and --init-PV take the distributions of cet_ensemble.py
+
+"""
+import sys
+import math
+import numpy as np
+import pid
+import pv_predict as pvp
+import cet_ensemble as cens
+
+default_tanks = 200
+default_chiller_capacity = 0.5   ### deg/h of one tank, per tank
+default_supply_temp = -2.0       ### design glycol supply temperature, degC
+default_glycol_mass = 0.1        ### glycol loop, tank equivalents per tank
+default_init_PV = 11.80          ### degC, as CET.model_with_pid
+
+class Chiller:
+  """
+  Glycol chiller and supply loop shared by tanks
+
+  capacity is heat removed per model time step, and glycol_mass the loop
+  thermal mass, both in tank equivalents; supply temperature Ts starts,
+  and is held, at supply_temp while heat absorbed is within capacity
+
+  """
+  def __init__(self,capacity,supply_temp=default_supply_temp,glycol_mass=1.0):
+    self.capacity,self.design_temp,self.glycol_mass = float(capacity),float(supply_temp),float(glycol_mass)
+    self.reset()
+
+  def reset(self):
+    self.supply_temp = self.design_temp
+
+  def effectiveness(self,PVs):
+    """Fraction of design cooling each tank at PVs receives at present Ts"""
+    if self.supply_temp == self.design_temp: return np.ones(len(PVs))
+    with np.errstate(divide='ignore',invalid='ignore'):
+      frac = (PVs - self.supply_temp) / (PVs - self.design_temp)
+    return np.where(PVs > self.design_temp,np.clip(frac,0.0,1.0),1.0)
+
+  def step(self,absorbed):
+    """Advance one model time step, with heat absorbed from tanks; return heat removed"""
+    removed = min(self.capacity,absorbed + (self.glycol_mass * (self.supply_temp - self.design_temp)))
+    self.supply_temp += (absorbed - removed) / self.glycol_mass
+    return removed
+
+
+class MultiTank(cens.Ensemble):
+  """
+  Closed-loop PID simulation of CET tanks sharing chiller
+
+  cet supplies PID tuning, setpoint, duration and model time step; params
+  is a dict of per-tank CET plant parameter arrays, and init_PVs the
+  initial tank temperatures, all the same length
+
+  """
+  def __init__(self,cet,params,chiller,init_PVs=None):
+    cens.Ensemble.__init__(self,cet,params)
+    self.chiller = chiller
+    self.init_PVs = np.full(self.members,default_init_PV) if None is init_PVs else np.asarray(init_PVs,dtype=np.float64)
+
+    ### Cooling at design supply temperature of each whole-percentage
+    ### valve position, per tank
+    self.cooling_table = self.Ke - self.CVscalar_table
+
+  def run(self,fix_backlash=False,settle_band=0.05):
+    """
+    Simulate tanks; return PID update times, tank PVs and valve positions
+    at those times, shape (updates,tanks), supply temperature at those
+    times, mean chiller duty (heat removed / capacity) from each to the
+    next, and dict of per-tank metric arrays
+
+    """
+    cet,M,chiller = self.cet,self.members,self.chiller
+    step = cet.model_time_step
+    nsteps = int(math.ceil(cet.pid_updatetime / step))
+    L = int(math.ceil(cet.pid_duration / cet.pid_updatetime))
+    dt = nsteps * step
+    setpoint = cet.pid_setpoint
+    zsteps = fix_backlash and min(2,nsteps) or 0
+
+    xPV,xTt = self.init_PVs.copy(),self.init_PVs.copy()
+    blCV = np.full(M,-1e32)
+    bank = pid.PIDBank(M)
+    for i in range(M):
+      bank.add_loop(cet.pid_Kc,cet.pid_Ti,cet.pid_Td
+                   ,CVlast=0.0
+                   ,Updatetime=cet.pid_updatetime
+                   ,Deadband=cet.pid_deadband
+                   )
+    setpoints = np.full(M,setpoint)
+    chiller.reset()
+
+    ATs = np.arange(L) * dt
+    rPVs,blCVs = np.zeros((L,M)),np.zeros((L,M))
+    supply_temps,duties = np.zeros(L),np.zeros(L)
+    nbacklash,unmet = np.zeros(M,dtype=np.int64),np.zeros(M)
+
+    for i in range(L):
+      rPV = np.round(xPV,2)
+      xCV = bank.control(rPV,setpoints)
+
+      ### Valve backlash, as in CET.xCV_to_CV
+      rCV = np.round(xCV,0)
+      up,closed = rCV >= blCV,rCV <= 0.0
+      backlash = ~(up | closed)
+      blCV = np.where(up,rCV,np.where(closed,0.0,blCV))
+      nbacklash += backlash
+      rPVs[i],blCVs[i],supply_temps[i] = rPV,blCV,chiller.supply_temp
+
+      ### Fix-backlash tanks spend the first zsteps model time steps at
+      ### zero CV, then the valve re-opens to the rounded PID CV
+      CVscalars = self.lookup_CVscalars(blCV)
+      coolings = self.cooling_table[blCV.astype(np.intp),self.imembers]
+      if zsteps and backlash.any():
+        pulse = (np.where(backlash,self.CVscalar_table[0],CVscalars)
+                ,np.where(backlash,self.cooling_table[0],coolings)
+                ,)
+        blCV = np.where(backlash,np.maximum(rCV,0.0) if nsteps > zsteps else 0.0,blCV)
+        CVscalars = np.where(backlash,self.lookup_CVscalars(blCV),CVscalars)
+        coolings = np.where(backlash,self.cooling_table[blCV.astype(np.intp),self.imembers],coolings)
+      else:
+        pulse = None
+
+      ### Advance tanks and chiller one model time step at a time; at
+      ### design supply temperature, shortfall is zero and CVscalars are
+      ### exactly those of the single tank model
+      removed = 0.0
+      for k in range(nsteps):
+        CVs,cools = pulse if (pulse and k < zsteps) else (CVscalars,coolings,)
+        shortfall = (1.0 - chiller.effectiveness(xPV)) * cools
+        unmet += shortfall
+        removed += chiller.step(float(np.sum(cools - shortfall)))
+        xTt = xTt + CVs + shortfall
+        xPV = xTt + ((xPV - xTt) * self.kPV_step) + self.Ke
+      duties[i] = removed / (nsteps * chiller.capacity)
+
+    ### Per-tank metrics of PV deviation, as cet_ensemble.py
+    errs = rPVs - setpoint
+    sign = np.where(rPVs[0] > setpoint,-1.0,1.0)
+    outside = np.abs(errs) > settle_band
+    lastout = np.where(outside.any(axis=0),L - 1 - np.argmax(outside[::-1],axis=0),-1)
+    settling = np.where(lastout < 0,0.0
+                       ,np.where(lastout + 1 < L,(lastout + 1) * dt,np.inf))
+    metrics = dict(IAE=np.abs(errs).sum(axis=0) * dt
+                  ,ISE=(errs * errs).sum(axis=0) * dt
+                  ,Overshoot=np.maximum((sign * errs).max(axis=0),0.0)
+                  ,Settling=settling
+                  ,Backlash=nbacklash
+                  ,Unmet=unmet
+                  )
+    return ATs,rPVs,blCVs,supply_temps,duties,metrics
+
+
+def plot_tanks(ATs,rPVs,blCVs,supply_temps,duties,title,setpoint=None):
+  """Tank PVs, valve positions, and chiller supply temperature and duty"""
+  import matplotlib.pyplot as plt
+
+  fig,(pvplt,cvplt,tsplt) = plt.subplots(nrows=3,ncols=1
+                                        ,sharex=True
+                                        ,gridspec_kw=dict(height_ratios=[3,1,1])
+                                        )
+  pvplt.plot(ATs,rPVs,linewidth=0.3)
+  if not (None is setpoint): pvplt.axhline(setpoint,color='k',linestyle='--',linewidth=0.5)
+  pvplt.set_ylabel('PV, degC')
+  pvplt.set_title(title)
+  cvplt.plot(ATs,blCVs,linewidth=0.3)
+  cvplt.set_ylabel('Valve, %')
+  tsplt.plot(ATs,supply_temps,color='C0',label='Supply, degC')
+  tsplt.set_ylabel('Supply, degC')
+  dutyplt = tsplt.twinx()
+  dutyplt.plot(ATs,duties * 100.0,color='C1',linewidth=0.5,label='Duty, %')
+  dutyplt.set_ylabel('Duty, %')
+  tsplt.set_xlabel('Time, s')
+  plt.show()
+
+
+if "__main__" == __name__:
+  args,keywords = pvp.process_args(sys.argv[1:])
+  cet = pvp.CET(*args,**dict([(k,v,) for k,v in keywords.items()
+                               if not (k in [key for key,attr in cens.param_keys])
+                              ]))
+  tanks = int(keywords.get('tanks',default_tanks))
+  seed = int(keywords['seed']) if 'seed' in keywords else None
+  params = cens.sample_parameters(cet,keywords,tanks,seed)
+  init_PVs = cens.sample(keywords.get('init-PV',default_init_PV)
+                        ,np.random.default_rng(None if None is seed else seed + 1)
+                        ,tanks)
+  per_step = tanks * cet.model_time_step / 3600.0
+  chiller = Chiller(float(keywords.get('chiller-capacity',default_chiller_capacity)) * per_step
+                   ,float(keywords.get('supply-temp',default_supply_temp))
+                   ,float(keywords.get('glycol-mass',default_glycol_mass)) * tanks
+                   )
+  plant = MultiTank(cet,params,chiller,init_PVs)
+  ATs,rPVs,blCVs,supply_temps,duties,metrics = plant.run('fix-backlash' in keywords
+                                                        ,settle_band=float(keywords.get('settle-band',0.05))
+                                                        )
+  cens.print_summary(metrics)
+  print('Peak supply temperature {0:.3f}degC; chiller at full capacity {1:.1f}% of time'.format(
+        supply_temps.max(),100.0 * np.mean(duties >= 1.0 - 1e-9)))
+  if cet.do_plot:
+    plot_tanks(ATs,rPVs,blCVs,supply_temps,duties
+              ,'{0} tanks Kc={1} Ti={2}min Td={3}min Update={4}s{5}'.format(
+               tanks,cet.pid_Kc,cet.pid_Ti,cet.pid_Td,cet.pid_updatetime
+              ,'fix-backlash' in keywords and ' fix-backlash' or '')
+              ,cet.pid_setpoint)
@@ -0,0 +1,132 @@
+"""
+Decimated, optionally headless, plotting of CET results (see pv_predict.py)
+
+Series are reduced to about as many points as there are pixels across
+the plot before they are passed to matplotlib:  within each of npoints
+equal-width bins of the x axis the first and last samples, and both ends
+of the runs of minimum and maximum values, are kept, so peaks and the
+edges of the backlash CV steps look the same as with every sample drawn.
+
+Figures saved to files are drawn on a non-interactive Agg canvas,
+without pyplot, so they work on headless servers and in worker
+processes; file names are built from the parameter set, and
+render_many draws many figures in a process pool.
+
+"""
+import re
+import multiprocessing
+import numpy as np
+
+default_npoints = 2000
+
+def decimate(x,y,npoints=default_npoints):
+  """
+  Return x,y reduced to first and last samples, and first and last
+  minimum and maximum samples, in each of npoints equal-width bins of x,
+  in original order; x must be sorted.  Keeping both ends of each run of
+  minimum or maximum values keeps both sides of each step edge.  Series
+  with no more than 6*npoints samples are returned as they are
+
+  """
+  x,y = np.asarray(x),np.asarray(y)
+  n = len(x)
+  if not npoints or n <= (6 * npoints): return x,y
+  edges = np.linspace(x[0],x[-1],npoints+1)
+  starts = np.unique(np.searchsorted(x,edges[:-1],side='left'))
+  ends = np.append(starts[1:],n)
+  bins = np.repeat(np.arange(len(starts)),ends - starts)
+
+  ### Positions of first and last minimum and maximum in each bin; NaNs
+  ### are never equal to the bin minimum or maximum, so they are skipped
+  keep = [starts,ends-1]
+  with np.errstate(invalid='ignore'):
+    yextremes = (np.fmin.reduceat(y,starts),np.fmax.reduceat(y,starts),)
+  positions = np.arange(n)
+  for yextreme in yextremes:
+    atextreme = y == yextreme[bins]
+    keep.append(np.minimum.reduceat(np.where(atextreme,positions,(ends-1)[bins]),starts))
+    keep.append(np.maximum.reduceat(np.where(atextreme,positions,starts[bins]),starts))
+
+  keep = np.unique(np.concatenate(keep))
+  return x[keep],y[keep]
+
+
+def draw(fig,args,npoints=default_npoints,setpoint=12.0):
+  """
+  Draw CET.plot_data arguments on matplotlib figure fig:  args is a
+  sequence of (ats,whichplot,xvtitle,xvpairs); see CET.plot_data
+
+  """
+  pvplt,cvplt = fig.subplots(nrows=2,ncols=1
+                            ,sharex=True
+                            ,gridspec_kw=dict(height_ratios=[3,1])
+                            )
+
+  pvplt.axhline(setpoint,label='SP',linewidth=0.5,linestyle='dotted')
+  pvplt.set_ylabel('Temperature, degC')
+  cvplt.set_ylabel('CV, %')
+  cvplt.set_xlabel('Time, s')
+
+  for ats,whichplot,xvtitle,xvpairs in args:
+    xvplt = whichplot.startswith('CV') and cvplt or pvplt
+    markerline = whichplot.endswith('dots') and '.' or '-'
+    if isinstance(xvtitle,str): xvplt.set_title(xvtitle)
+    for xvs,xvlegend in xvpairs:
+      ### Dots are events, not series; keep them all
+      if '-' == markerline: plotats,plotxvs = decimate(ats,xvs,npoints)
+      else                : plotats,plotxvs = ats,xvs
+      xvplt.plot(plotats,plotxvs
+                ,markerline
+                ,label=xvlegend
+                ,linewidth='Backlash CV' == xvlegend and 0.5 or None
+                ,markersize=0.5
+                )
+    xvplt.legend(loc=xvplt is cvplt and 'center right' or 'best')
+  return pvplt,cvplt
+
+
+def save(path,args,npoints=default_npoints,setpoint=12.0,figsize=(12.8,7.2),dpi=100):
+  """Draw CET.plot_data arguments to image file path; format from extension"""
+  from matplotlib.figure import Figure
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+  fig = Figure(figsize=figsize,dpi=dpi)
+  FigureCanvasAgg(fig)
+  draw(fig,args,npoints,setpoint)
+  fig.savefig(path)
+  return path
+
+
+def show(args,npoints=default_npoints,setpoint=12.0):
+  """Draw CET.plot_data arguments in interactive pyplot window"""
+  import matplotlib.pyplot as plt
+
+  draw(plt.figure(),args,npoints,setpoint)
+  plt.show()
+
+
+def figure_name(prefix,params,fmt='png'):
+  """
+  Image file name from prefix and sequence of (name,value) parameters,
+  e.g. pid_Kc50_Ti60_Td0_Update45.png
+
+  """
+  toks = [prefix] + ['{0}{1:g}'.format(name,value) for name,value in params]
+  return re.sub('[^-_.A-Za-z0-9]','_','_'.join(toks)) + '.' + fmt
+
+
+def save_job(job):
+  path,args,keywords = job
+  return save(path,args,**keywords)
+
+
+def render_many(jobs,processes=0):
+  """
+  Save many figures in a process pool; jobs is a sequence of (path,args,
+  keywords), with args and keywords for save(); return paths written
+
+  """
+  processes = processes or multiprocessing.cpu_count()
+  if processes < 2 or len(jobs) < 2: return list(map(save_job,jobs))
+  with multiprocessing.Pool(processes) as pool:
+    return list(pool.imap_unordered(save_job,jobs))
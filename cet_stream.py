@@ -0,0 +1,92 @@
+"""
+Bounded-memory output of long CET simulations (see pv_predict.py)
+
+CET.iter_with_pid and CET.iter_replay yield their results in blocks of a
+fixed number of records; stream() consumes such blocks, keeping running
+summary statistics of each series and optionally writing the blocks to a
+tab-separated file, so memory stays the same whatever the duration.
+
+Summary statistics (count, mean, standard deviation, minimum, maximum;
+count of True values for flags) are merged block by block with the
+pairwise update of Chan et al., so they equal those of the whole series
+to floating-point tolerance.
+
+"""
+import numpy as np
+
+default_block_size = 4096
+
+class Summary:
+  """Running summary statistics of named series, updated one block at a time"""
+  def __init__(self):
+    self.series = dict()
+
+  def update(self,name,values):
+    """Merge block of values of series name"""
+    values = np.asarray(values)
+    nb = len(values)
+    if not nb: return
+    if values.dtype == np.bool_:
+      self.series[name] = self.series.get(name,0) + int(values.sum())
+      return
+    mb = float(values.mean())
+    M2b = float(np.sum((values - mb)**2))
+    lo,hi = float(values.min()),float(values.max())
+    if not (name in self.series):
+      self.series[name] = [nb,mb,M2b,lo,hi]
+      return
+    s = self.series[name]
+    n = s[0] + nb
+    delta = mb - s[1]
+    s[1] += delta * nb / n
+    s[2] += M2b + (delta * delta * s[0] * nb / n)
+    s[0],s[3],s[4] = n,min(s[3],lo),max(s[4],hi)
+
+  def as_dict(self):
+    """Summary statistics, as dict of series name:dict, or count of True flags"""
+    result = dict()
+    for name,s in self.series.items():
+      if isinstance(s,int): result[name] = dict(count_true=s)
+      else                : result[name] = dict(count=s[0],mean=s[1],std=(s[2] / s[0])**0.5
+                                                 ,min=s[3],max=s[4])
+    return result
+
+
+class TSVSink:
+  """Write blocks of equal-length series as rows of a tab-separated file"""
+  def __init__(self,path,names):
+    self.fout = open(path,'w')
+    self.fout.write('\t'.join(names)+'\n')
+
+  def write(self,columns):
+    np.savetxt(self.fout,np.column_stack(columns),fmt='%.10g',delimiter='\t')
+
+  def close(self):
+    self.fout.close()
+
+
+def stream(blocks,names,path=None):
+  """
+  Consume blocks, each a tuple of series named by names, of which the
+  arrays of equal length (one record per element) are summarized and,
+  with path, written to a TSV file; lists (e.g. zeroCV_ATs) are only
+  counted.  Return summary dict, with number of blocks
+
+  """
+  summary,nblocks = Summary(),0
+  sink = None
+  try:
+    for block in blocks:
+      nblocks += 1
+      columns = [(name,values,) for name,values in zip(names,block) if not isinstance(values,list)]
+      for name,values in zip(names,block):
+        if isinstance(values,list): summary.update(name,np.ones(len(values),dtype=np.bool_))
+        else                      : summary.update(name,values)
+      if path:
+        if None is sink: sink = TSVSink(path,[name for name,values in columns])
+        sink.write([values for name,values in columns])
+  finally:
+    if sink: sink.close()
+  result = summary.as_dict()
+  result['blocks'] = nblocks
+  return result
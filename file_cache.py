@@ -0,0 +1,65 @@
+"""
+Helpers for size-bounded on-disk caches of binary files:  cache keys,
+atomic writes, and least-recently-used eviction
+
+Cache files are written to a temporary file in the cache directory and
+renamed into place, so readers in other processes never see a partial
+file; a cache hit updates the file's modification time, and eviction
+removes the files with the oldest modification times first.
+
+"""
+import os
+import hashlib
+import tempfile
+
+def file_digest(path,blocksize=1<<20):
+  """Return SHA-256 hex digest of contents of file at path"""
+  h = hashlib.sha256()
+  with open(path,'rb') as fin:
+    for block in iter(lambda:fin.read(blocksize),b''): h.update(block)
+  return h.hexdigest()
+
+
+def key_digest(*parts):
+  """Return SHA-256 hex digest of repr of parts, for use as a cache key"""
+  return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+def atomic_save(path,writer):
+  """Call writer(fileobj) on a temporary file, then rename it to path"""
+  fd,tmppath = tempfile.mkstemp(dir=os.path.dirname(path),prefix='.tmp-')
+  try:
+    with os.fdopen(fd,'wb') as fout: writer(fout)
+    os.replace(tmppath,path)
+  except:
+    try: os.unlink(tmppath)
+    except OSError: pass
+    raise
+
+
+def touch(path):
+  """Mark cache file at path as recently used"""
+  try: os.utime(path)
+  except OSError: pass
+
+
+def evict(cache_dir,max_bytes,suffix='',keep=()):
+  """
+  Remove least-recently-used files ending in suffix from cache_dir until
+  their total size is at most max_bytes; never remove paths in keep
+
+  """
+  entries = list()
+  for name in os.listdir(cache_dir):
+    if name.startswith('.tmp-') or not name.endswith(suffix): continue
+    path = os.path.join(cache_dir,name)
+    try: st = os.stat(path)
+    except OSError: continue
+    entries.append((st.st_mtime,st.st_size,path,))
+  total = sum([size for mtime,size,path in entries])
+  for mtime,size,path in sorted(entries):
+    if total <= max_bytes: break
+    if path in keep: continue
+    try: os.unlink(path)
+    except OSError: pass          ### Another process evicted it already
+    total -= size
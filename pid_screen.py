@@ -0,0 +1,338 @@
+"""
+Linearized closed-loop screening of PID tuning for CET (see pv_predict.py)
+
+Ranks many combinations of PID parameters without running the nonlinear
+model:  the CET plant is linearized at its operating point, where the
+valve holds the tank temperature steady (CVscalar of 0), using Ke,
+kPV_step and the slope of CET.calculate_CVscalar there, and discretized
+at each PID update time.  With the velocity form of pid.PID, each
+combination is then a small linear closed loop, evaluated for all
+combinations at once as arrays:
+
+  - Rho:  largest closed-loop pole magnitude; stable if less than 1
+  - PM, GM:  phase margin (degrees) and gain margin (ratio) of the loop
+  - Ms:  peak sensitivity, 1 / distance of loop from -1
+  - IAE, ISE, Overshoot, Settling:  as pid_sweep.py, of the linear
+    response from the initial state of CET.model_with_pid, with the CV
+    clamped to [0:100] as in pid.PID
+  - CVmin, CVmax:  CV range of that response, %
+
+Valve rounding and backlash, and PV rounding, are not modeled.  Rows
+are sorted by --sort among combinations that are stable with at least
+--min-PM phase margin and at most --max-Ms peak sensitivity (OK=1),
+then the rest; --verify=N runs the first N through the nonlinear model
+with pid_sweep.py.
+
+Usage:
+
+  python pid_screen.py [--pid-Kc=1:100:1] [--pid-Ti=2:120:2] [--pid-Td=0,0.5,1.5] \\
+                       [--pid-updatetime=45] [--min-PM=30] [--max-Ms=2] \\
+                       [--sort=IAE] [--reverse] [--top=20] [--tsv] \\
+                       [--settle-band=0.05] [--verify=N [--fix-backlash] [--processes=N]] \\
+                       [other pv_predict.py model arguments]
+
+  Lists and ranges of values are as in pid_sweep.py
+
+"""
+import sys
+import math
+import time
+import numpy as np
+import multiprocessing
+import pv_predict as pvp
+import pid_sweep
+
+init_PV = 11.80          ### degC, initial PV and Tt of CET.model_with_pid
+npoints_frequency = 400  ### Frequencies of loop response, log-spaced
+
+### Result columns, in table order, and their output formats
+screen_columns = (('Kc','{0:g}',)
+                 ,('Ti','{0:g}',)
+                 ,('Td','{0:g}',)
+                 ,('Update','{0:g}',)
+                 ,('OK','{0:d}',)
+                 ,('Rho','{0:.4f}',)
+                 ,('PM','{0:.1f}',)
+                 ,('GM','{0:.3g}',)
+                 ,('Ms','{0:.3g}',)
+                 ,('IAE','{0:.4g}',)
+                 ,('ISE','{0:.4g}',)
+                 ,('Overshoot','{0:.3f}',)
+                 ,('Settling','{0:.0f}',)
+                 ,('CVmin','{0:.1f}',)
+                 ,('CVmax','{0:.1f}',)
+                 ,)
+
+def operating_point(cet,tolerance=1e-9):
+  """
+  Return valve position CV0 where CET.calculate_CVscalar is 0, i.e. tank
+  temperature is steady, by bisection, and slope of CVscalar there, per %
+
+  """
+  lo,hi = 0.0,100.0
+  assert cet.calculate_CVscalar(lo) > 0.0 > cet.calculate_CVscalar(hi),'No valve position holds tank temperature steady'
+  while (hi - lo) > tolerance:
+    mid = 0.5 * (lo + hi)
+    if cet.calculate_CVscalar(mid) > 0.0: lo = mid
+    else                                : hi = mid
+  CV0 = 0.5 * (lo + hi)
+  h = min(1e-3,0.5 * (CV0 - cet.CVe0))
+  return CV0,(cet.calculate_CVscalar(CV0 + h) - cet.calculate_CVscalar(CV0 - h)) / (2.0 * h)
+
+
+def polymul(p,q):
+  """Product of polynomials, one per row of p and q, highest power first"""
+  result = np.zeros((p.shape[0],p.shape[1]+q.shape[1]-1))
+  for j in range(q.shape[1]): result[:,j:j+p.shape[1]] += p * q[:,j:j+1]
+  return result
+
+
+def polyval(p,z):
+  """Values of polynomials, one per row of p, at each of z; shape (rows,len(z))"""
+  result = np.broadcast_to(p[:,:1],(p.shape[0],len(z))).astype(np.complex128)
+  for j in range(1,p.shape[1]): result = (result * z) + p[:,j:j+1]
+  return result
+
+
+class LinearCET:
+  """
+  CET plant linearized at operating point, sampled at PID updates
+
+  Between updates the CV deviation u from CV0 is held, so, per model time
+  step, Tt deviation rises by slope * u, and PV-Tt deviation D decays by
+  kPV_step and falls by kPV_step * slope * u.  Over nsteps model time
+  steps:  Tt += b1 * u; D = kn * D + b2 * u; PV deviation is Tt + D
+
+  """
+  def __init__(self,cet):
+    self.cet = cet
+    self.CV0,self.slope = operating_point(cet)
+    self.kPV_step = cet.kPV_step
+    assert self.kPV_step < 1.0,'kPV must be less than 1 for steady PV'
+
+    ### Equilibrium with PV at setpoint, and initial deviations from it
+    Dstar = cet.Ke / (1.0 - self.kPV_step)
+    self.Tt0,self.D0 = init_PV - (cet.pid_setpoint - Dstar),-Dstar
+
+  def discretize(self,Updatetimes):
+    """Return nsteps, kn, b1 and b2 arrays for array of PID update times"""
+    k = self.kPV_step
+    nsteps = np.ceil(np.asarray(Updatetimes) / self.cet.model_time_step)
+    kn = k**nsteps
+    return nsteps,kn,nsteps * self.slope,-self.slope * k * (1.0 - kn) / (1.0 - k)
+
+
+def loop_polynomials(plant,Kc,Ti,Td,Updatetimes):
+  """
+  Return numerator and denominator polynomials of loop transfer function
+  -P(z)C(z), one row per combination:  P(z), from u to PV deviation, is
+  b1/(z-1) + b2/(z-kn); C(z), from PV to CV, of velocity form PID, is
+  Kc ((1+a+d) z^2 - (1+2d) z + d) / (z (z-1)), with a = Updatetime/60Ti
+  and d = 60Td/Updatetime
+
+  """
+  nsteps,kn,b1,b2 = plant.discretize(Updatetimes)
+  a,d = Updatetimes / (60.0 * Ti),60.0 * Td / Updatetimes
+  ones,zeros = np.ones(len(Kc)),np.zeros(len(Kc))
+  plantnum = np.column_stack((b1 + b2,-(b1 * kn) - b2,))
+  pidnum = Kc[:,np.newaxis] * np.column_stack((1.0 + a + d,-(1.0 + 2.0 * d),d,))
+  plantden = np.column_stack((ones,-(1.0 + kn),kn,))
+  pidden = np.column_stack((ones,-ones,zeros,))
+  return -polymul(plantnum,pidnum),polymul(plantden,pidden)
+
+
+def spectral_radius(num,den):
+  """Largest magnitude of roots of den + num, the closed-loop poles"""
+  char = den.copy()
+  char[:,-num.shape[1]:] += num
+  n = char.shape[1] - 1
+  companion = np.zeros((char.shape[0],n,n))
+  companion[:,0,:] = -char[:,1:] / char[:,:1]
+  companion[:,np.arange(1,n),np.arange(n-1)] = 1.0
+  return np.abs(np.linalg.eigvals(companion)).max(axis=1)
+
+
+def margins(num,den,npoints=npoints_frequency,chunk=1024):
+  """
+  Return phase margin (degrees), gain margin and peak sensitivity of
+  loop num/den, from its response at npoints log-spaced frequencies up
+  to the Nyquist frequency; PM is NaN without gain crossover, GM inf
+  without phase crossover above it.  Rows are done chunk at a time, so
+  the responses stay in cache
+
+  """
+  z = np.exp(1j * np.pi * np.logspace(-4.0,0.0,npoints))
+  M = len(num)
+  PM,GM,Ms = np.empty(M),np.empty(M),np.empty(M)
+  for j in range(0,M,chunk):
+    k = min(M,j+chunk)
+    loop = polyval(num[j:k],z)
+    loop /= polyval(den[j:k],z)
+    mag = np.abs(loop)
+
+    ### Gain crossover:  first frequency where loop gain falls below 1
+    below = mag < 1.0
+    ic = np.argmax(below,axis=1)
+    PM[j:k] = np.where(below.any(axis=1),np.degrees(np.angle(-loop[np.arange(k-j),ic])),np.nan)
+
+    ### Phase crossovers above gain crossover:  loop crosses negative real axis
+    crossing = (loop.imag[:,:-1] * loop.imag[:,1:]) <= 0.0
+    crossing &= loop.real[:,:-1] < 0.0
+    crossing &= np.arange(npoints-1) >= ic[:,np.newaxis]
+    GM[j:k] = np.where(crossing,1.0 / mag[:,:-1],np.inf).min(axis=1)
+    loop += 1.0
+    Ms[j:k] = 1.0 / np.abs(loop).min(axis=1)
+  return PM,GM,Ms
+
+
+def step_metrics(plant,Kc,Ti,Td,Updatetime,settle_band=0.05,chunk=8192,block=64):
+  """
+  Metrics of linear closed-loop response from the initial state of
+  CET.model_with_pid, for combinations with the same Updatetime; each
+  PID update is that of pid.PID, including CV clamping, for chunk
+  combinations at once, with metrics taken over blocks of updates
+
+  """
+  cet = plant.cet
+  nsteps,kn,b1,b2 = plant.discretize(Updatetime)
+  L = int(math.ceil(cet.pid_duration / Updatetime))
+  dt = float(nsteps) * cet.model_time_step
+  ulo,uhi = -plant.CV0,100.0 - plant.CV0
+
+  ### As pid_sweep.closed_loop_metrics; all combinations start at the
+  ### same error, so overshoot is on the same side for all
+  err0 = plant.Tt0 + plant.D0
+  sign = (err0 > 0.0) and -1.0 or 1.0
+  names = ('IAE','ISE','Overshoot','Settling','CVmin','CVmax',)
+  result = dict([(name,np.empty(len(Kc)),) for name in names])
+
+  for j in range(0,len(Kc),chunk):
+    k = min(len(Kc),j+chunk)
+    m = k - j
+    a,d = Updatetime / (60.0 * Ti[j:k]),60.0 * Td[j:k] / Updatetime
+    c0,c1,c2 = Kc[j:k] * (1.0 + a + d),Kc[j:k] * (1.0 + 2.0 * d),Kc[j:k] * d
+
+    ### PID update:  du = Kc ((err - lastErr) + a err + d (err + errm2 -
+    ### 2 errm1)), with PV differences as error differences at constant
+    ### setpoint; first update is bumpless, from errm1 = errm2 = err
+    Tt,D,u = np.full(m,plant.Tt0),np.full(m,plant.D0),np.full(m,ulo)
+    errm1 = errm2 = np.full(m,err0)
+    du,tmp = np.empty(m),np.empty(m)
+    errs,us = np.empty((block,m)),np.empty((block,m))
+    IAE,ISE,peak = np.zeros(m),np.zeros(m),np.full(m,-np.inf)
+    lastout,CVmin,CVmax = np.full(m,-1),np.full(m,np.inf),np.full(m,-np.inf)
+    for i in range(L):
+      b = i % block
+      err = errs[b]
+      np.add(Tt,D,out=err)
+      np.multiply(c0,err,out=du)
+      du -= np.multiply(c1,errm1,out=tmp)
+      du += np.multiply(c2,errm2,out=tmp)
+      u += du
+      np.clip(u,ulo,uhi,out=u)
+      us[b] = u
+      Tt += np.multiply(b1,u,out=tmp)
+      D *= kn
+      D += np.multiply(b2,u,out=tmp)
+      errm2,errm1 = errm1,err
+
+      if (b + 1 == block) or (i + 1 == L):
+        errb,ub = errs[:b+1],us[:b+1]
+        IAE += np.abs(errb).sum(axis=0)
+        ISE += np.einsum('ij,ij->j',errb,errb)
+        peak = np.maximum(peak,sign * (errb.max(axis=0) if sign > 0.0 else errb.min(axis=0)))
+        outside = np.abs(errb) > settle_band
+        lastout = np.where(outside.any(axis=0),i - np.argmax(outside[::-1],axis=0),lastout)
+        CVmin,CVmax = np.minimum(CVmin,ub.min(axis=0)),np.maximum(CVmax,ub.max(axis=0))
+        ### Keep last two errors, as rows of next block will overwrite them
+        errm2,errm1 = errm2.copy(),errm1.copy()
+
+    result['IAE'][j:k],result['ISE'][j:k] = IAE * dt,ISE * dt
+    result['Overshoot'][j:k] = np.maximum(peak,0.0)
+    result['Settling'][j:k] = np.where(lastout < 0,0.0
+                                      ,np.where(lastout + 1 < L,(lastout + 1) * dt,np.inf))
+    result['CVmin'][j:k],result['CVmax'][j:k] = plant.CV0 + CVmin,plant.CV0 + CVmax
+  return result
+
+
+def screen(cet,grids,min_PM=30.0,max_Ms=2.0,settle_band=0.05):
+  """
+  Evaluate all combinations of grids of Kc, Ti, Td and Updatetime;
+  return dict of column name:array, one element per combination
+
+  """
+  Kc,Ti,Td,Update = np.array(np.meshgrid(*grids,indexing='ij')).reshape(len(grids),-1)
+  plant = LinearCET(cet)
+  num,den = loop_polynomials(plant,Kc,Ti,Td,Update)
+  columns = dict(Kc=Kc,Ti=Ti,Td=Td,Update=Update)
+  columns['Rho'] = spectral_radius(num,den)
+  columns['PM'],columns['GM'],columns['Ms'] = margins(num,den)
+  columns['OK'] = ((columns['Rho'] < 1.0) & (columns['PM'] >= min_PM) & (columns['Ms'] <= max_Ms)).astype(np.int64)
+
+  ### Step responses of stable combinations, grouped by update time;
+  ### the others diverge, so their metrics are inf
+  stable = columns['Rho'] < 1.0
+  for name,fmt in screen_columns[-6:]: columns[name] = np.full(len(Kc),np.inf)
+  for updatetime in np.unique(Update[stable]):
+    group = stable & (Update == updatetime)
+    for name,values in step_metrics(plant,Kc[group],Ti[group],Td[group],updatetime,settle_band).items():
+      columns[name][group] = values
+  return columns
+
+
+def ranked(columns,sort_key='IAE',reverse=False):
+  """Return row indices, OK rows first, each part sorted by sort_key"""
+  values = columns[sort_key]
+  if reverse: values = -values
+  return np.lexsort((values,-columns['OK'],))
+
+
+def print_table(columns,order,tsv=False,fout=sys.stdout):
+  """Write rows order of columns, as aligned or tab-separated table"""
+  lines = [[name for name,fmt in screen_columns]]
+  for i in order:
+    lines.append([fmt.format(columns[name][i].item()) for name,fmt in screen_columns])
+  if tsv:
+    for line in lines: fout.write('\t'.join(line)+'\n')
+    return
+  widths = [max([len(line[i]) for line in lines]) for i in range(len(screen_columns))]
+  for line in lines:
+    fout.write('  '.join([tok.rjust(width) for tok,width in zip(line,widths)])+'\n')
+
+
+def verify(args,keywords,columns,order):
+  """Run combinations order through nonlinear model, as pid_sweep.py; return its table rows"""
+  fix_backlash = 'fix-backlash' in keywords
+  combinations = [([float(columns[column][i]) for key,attr,column in pid_sweep.sweep_keys],fix_backlash,)
+                  for i in order
+                 ]
+  processes = min(len(combinations),int(keywords.get('processes',0)) or multiprocessing.cpu_count())
+  pool_keywords = dict([(k,v,) for k,v in keywords.items() if not (k in [key for key,attr,column in pid_sweep.sweep_keys])])
+  with multiprocessing.Pool(processes,initializer=pid_sweep.init_worker,initargs=(args,pool_keywords,)) as pool:
+    return pool.map(pid_sweep.run_one,combinations)
+
+
+if "__main__" == __name__:
+  args,keywords = pvp.process_args(sys.argv[1:])
+  cet = pvp.CET(*args,**dict([(k,v,) for k,v in keywords.items()
+                               if not (k in [key for key,attr,column in pid_sweep.sweep_keys])
+                              ],**{'no-plot':True}))
+  grids = [pid_sweep.parse_grid(keywords.get(key,getattr(pvp.CET,'default_'+attr)))
+           for key,attr,column in pid_sweep.sweep_keys
+          ]
+  t0 = time.time()
+  columns = screen(cet,grids
+                  ,float(keywords.get('min-PM',30.0))
+                  ,float(keywords.get('max-Ms',2.0))
+                  ,float(keywords.get('settle-band',0.05))
+                  )
+  sys.stderr.write('Screened {0} combinations in {1:.3f}s; {2} OK\n'.format(
+                   len(columns['Kc']),time.time() - t0,int(columns['OK'].sum())))
+  order = ranked(columns,keywords.get('sort','IAE'),'reverse' in keywords)
+  print_table(columns,order[:int(keywords.get('top',20))],'tsv' in keywords)
+
+  if 'verify' in keywords:
+    order = order[:int(keywords['verify'])]
+    rows = verify(args,keywords,columns,order)
+    print('')
+    pid_sweep.print_table(rows,keywords.get('sort','IAE'),'reverse' in keywords,'tsv' in keywords)
@@ -0,0 +1,300 @@
+"""
+Real-time supervisory PID service:  many pid.PID loops, each on its own
+Updatetime schedule, reading PV/SP and writing CV through tag I/O
+
+One asyncio scheduler keeps a heap of next-due times, and fires each
+loop's update as a task at a fixed rate (due times do not drift with
+update duration); tag reads and writes run concurrently, bounded in
+number and in time, so one slow or stuck tag cannot delay other loops.
+A loop whose previous update is still in flight skips that cycle
+(counted as an overrun) instead of queueing up behind it.
+
+Reported per update:
+- Jitter:  how late the update fired, vs. its scheduled time
+- Latency:  from firing to CV written, including waits for I/O
+  (percentiles of both are over the last 100000 updates)
+- Deadline misses:  updates where jitter+latency exceeded Updatetime
+- Errors:  updates that raised an exception; each loop's first one is
+  logged to stderr, and its last traceback kept in the summary
+
+SimulatedPLC is a local stand-in for PLC tag I/O, with one CET model
+(see pv_predict.py) per tank, advanced by CET.model_one_timestep in
+(scaled) real time, so the service runs without hardware.
+
+Usage:
+
+  python pid_service.py [--loops=1000] [--duration=300] [--time-scale=1] \\
+                        [--io-latency=0.005] [--io-timeout=5] \\
+                        [--max-inflight=256] [--json=stats.json] \\
+                        [other pv_predict.py model and PID arguments]
+
+  - --time-scale=N runs the simulated plant, and the loop schedules, N
+    times faster than real time; times reported are wall-clock
+  - --duration is in wall-clock seconds
+
+"""
+import abc
+import sys
+import json
+import time
+import heapq
+import asyncio
+import traceback
+import collections
+import numpy as np
+import pid
+import pv_predict as pvp
+
+### Jitter and latency percentiles are of the most recent samples only,
+### so memory stays bounded however long the service runs
+default_max_samples = 100000
+
+
+class TagIO(abc.ABC):
+  """
+  Tag I/O interface; subclasses connect to a PLC, OPC server, etc., and
+  must implement both methods, or cannot be instantiated
+
+  Both methods are coroutines, and may be called concurrently for many
+  loops; they should not block the event loop (use non-blocking clients,
+  or loop.run_in_executor for blocking ones)
+
+  """
+  @abc.abstractmethod
+  async def read(self,tags):
+    """Return list of values of tags"""
+
+  @abc.abstractmethod
+  async def write(self,tag_values):
+    """Write sequence of (tag,value) pairs"""
+
+
+class SimulatedPLC(TagIO):
+  """
+  Simulated PLC holding one Chilled Exothermic Tank per PID loop
+
+  Tags for tank NAME are NAME.PV (read only; rounded to 0.01 as in
+  CET.model_with_pid), NAME.SP and NAME.CV; CV writes pass through the
+  CET valve backlash model.  Each tank is advanced, one model time step
+  at a time, to the current simulated time whenever its tags are read or
+  written; simulated time is time_scale times the clock, in seconds
+
+  """
+  def __init__(self,cet,time_scale=1.0,latency=0.0,clock=None):
+    self.cet,self.time_scale,self.latency = cet,time_scale,latency
+    self.clock = clock or time.monotonic
+    self.t0 = self.clock()
+    self.tags,self.tanks = dict(),dict()
+
+  def add_tank(self,name,setpoint,PV=11.80,Tt=11.80,CV=0.0):
+    """Add tank and its tags; initial state as in CET.model_with_pid"""
+    blCV,rCV,xCV,CVscalar,backlash = self.cet.xCV_to_CV(CV,-1e32)
+    ### Tank state:  [AT,Tt,PV,blCV,CVscalar]
+    self.tanks[name] = [0.0,Tt,PV,blCV,CVscalar]
+    self.tags[name+'.SP'],self.tags[name+'.CV'] = setpoint,CV
+    return name+'.PV',name+'.SP',name+'.CV'
+
+  def now(self):
+    """Simulated time, seconds"""
+    return (self.clock() - self.t0) * self.time_scale
+
+  def advance(self,name):
+    """Step tank model up to current simulated time"""
+    tank,now = self.tanks[name],self.now()
+    AT,Tt,PV,blCV,CVscalar = tank
+    while AT < now: AT,Tt,PV = self.cet.model_one_timestep(AT,Tt,PV,CVscalar)
+    tank[:3] = AT,Tt,PV
+
+  async def read(self,tags):
+    if self.latency: await asyncio.sleep(self.latency)
+    values = list()
+    for tag in tags:
+      name,field = tag.rsplit('.',1)
+      if 'PV' == field:
+        self.advance(name)
+        values.append(round(self.tanks[name][2],2))
+      else:
+        values.append(self.tags[tag])
+    return values
+
+  async def write(self,tag_values):
+    if self.latency: await asyncio.sleep(self.latency)
+    for tag,value in tag_values:
+      name,field = tag.rsplit('.',1)
+      assert 'PV' != field,'Tag {0} is read-only'.format(tag)
+      self.tags[tag] = value
+      if 'CV' == field:
+        ### Run tank at old CV up to now, then apply new valve position
+        self.advance(name)
+        tank = self.tanks[name]
+        tank[3],rCV,xCV,tank[4],backlash = self.cet.xCV_to_CV(value,tank[3])
+
+
+class ServiceStats:
+  """
+  Accumulate per-update timings, the last max_samples of each, and event
+  counts, and the last exception traceback of each loop whose update
+  raised one
+
+  """
+  def __init__(self,max_samples=default_max_samples):
+    self.jitters = collections.deque(maxlen=max_samples)
+    self.latencies = collections.deque(maxlen=max_samples)
+    self.counts = dict(updates=0,overruns=0,timeouts=0,errors=0,deadline_misses=0)
+    self.last_errors = dict()
+
+  def error(self,name):
+    """Count exception being handled in update of loop name; log its first one"""
+    self.counts['errors'] += 1
+    if not (name in self.last_errors):
+      sys.stderr.write('Loop {0} update failed (later failures are counted only):\n'.format(name))
+      traceback.print_exc(file=sys.stderr)
+    self.last_errors[name] = traceback.format_exc()
+
+  def summary(self):
+    """
+    Return dict of counts (of all updates), of jitter and latency
+    percentiles in ms (of the most recent samples), and of last exception
+    traceback by loop name, if any
+
+    """
+    result = dict(self.counts)
+    if self.last_errors: result['last_errors'] = dict(self.last_errors)
+    for name,values in (('jitter_ms',self.jitters,),('latency_ms',self.latencies,),):
+      if not values: continue
+      arr = np.array(values) * 1e3
+      result[name] = dict(zip(('p50','p95','p99','max',)
+                             ,[float(v) for v in np.percentile(arr,(50,95,99,100,))]
+                             ))
+      result[name]['mean'] = float(arr.mean())
+    return result
+
+
+class ServiceLoop:
+  """One PID loop in the service:  controller, tags and schedule"""
+  def __init__(self,name,ctlpid,pvtag,sptag,cvtag,period):
+    (self.name,self.pid,self.pvtag,self.sptag,self.cvtag,self.period
+    ,) = name,ctlpid,pvtag,sptag,cvtag,period
+    self.busy = False
+
+
+class PIDService:
+  """
+  Schedule and run PID loop updates against a TagIO
+
+  time_scale divides each loop's Updatetime to give its period in clock
+  seconds; io_timeout limits each read or write; max_inflight limits the
+  number of updates doing I/O at once
+
+  """
+  def __init__(self,tagio,time_scale=1.0,io_timeout=5.0,max_inflight=256):
+    self.tagio,self.time_scale,self.io_timeout = tagio,time_scale,io_timeout
+    self.max_inflight = max_inflight
+    self.loops,self.stats = list(),ServiceStats()
+
+  def add_loop(self,name,ctlpid,pvtag,sptag,cvtag):
+    self.loops.append(ServiceLoop(name,ctlpid,pvtag,sptag,cvtag
+                                 ,ctlpid.Updatetime / self.time_scale
+                                 ))
+
+  async def update(self,svcloop,due,fired):
+    """Read PV and SP, run one PID update, write CV; record timings"""
+    stats = self.stats
+    try:
+      async with self.semaphore:
+        pv,sp = await asyncio.wait_for(self.tagio.read((svcloop.pvtag,svcloop.sptag,))
+                                      ,self.io_timeout)
+        cv = svcloop.pid.control(pv,sp)
+        await asyncio.wait_for(self.tagio.write(((svcloop.cvtag,cv,),))
+                              ,self.io_timeout)
+      done = self.clock()
+      stats.jitters.append(fired - due)
+      stats.latencies.append(done - fired)
+      stats.counts['updates'] += 1
+      if (done - due) > svcloop.period: stats.counts['deadline_misses'] += 1
+    except asyncio.TimeoutError:
+      stats.counts['timeouts'] += 1
+    except Exception:
+      stats.error(svcloop.name)
+    finally:
+      svcloop.busy = False
+
+  async def run(self,duration=None):
+    """Run scheduler for duration clock seconds, or forever if None"""
+    self.clock = asyncio.get_running_loop().time
+    self.semaphore = asyncio.Semaphore(self.max_inflight)
+    start = self.clock()
+    stop = (None is duration) and float('inf') or (start + duration)
+
+    ### Spread first updates across each loop's period, so loops with
+    ### the same Updatetime do not all fire at once
+    N = max(1,len(self.loops))
+    heap = [(start + (i * svcloop.period / N),i,) for i,svcloop in enumerate(self.loops)]
+    heapq.heapify(heap)
+    tasks = set()
+
+    while heap and heap[0][0] < stop:
+      due,i = heap[0]
+      now = self.clock()
+      if due > now:
+        await asyncio.sleep(due - now)
+        continue
+      svcloop = self.loops[i]
+      if svcloop.busy:
+        self.stats.counts['overruns'] += 1
+      else:
+        svcloop.busy = True
+        task = asyncio.ensure_future(self.update(svcloop,due,now))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+      ### Fixed-rate schedule; skip whole periods already missed
+      nextdue = due + svcloop.period
+      if nextdue <= now:
+        missed = int((now - nextdue) // svcloop.period) + 1
+        self.stats.counts['overruns'] += missed
+        nextdue += missed * svcloop.period
+      heapq.heapreplace(heap,(nextdue,i,))
+
+    if tasks: await asyncio.wait(tasks,timeout=self.io_timeout * 2)
+    return self.stats.summary()
+
+
+########################################################################
+def simulated_service(args,keywords):
+  """Build PIDService with one SimulatedPLC tank per loop, from CLI keywords"""
+  cet = pvp.CET(*args,**dict(keywords,**{'no-plot':True}))
+  time_scale = float(keywords.get('time-scale',1.0))
+  plc = SimulatedPLC(cet,time_scale=time_scale
+                    ,latency=float(keywords.get('io-latency',0.0))
+                    )
+  service = PIDService(plc,time_scale=time_scale
+                      ,io_timeout=float(keywords.get('io-timeout',5.0))
+                      ,max_inflight=int(keywords.get('max-inflight',256))
+                      )
+  for i in range(int(keywords.get('loops',1000))):
+    name = 'tank{0}'.format(i)
+    pvtag,sptag,cvtag = plc.add_tank(name,cet.pid_setpoint)
+    service.add_loop(name
+                    ,pid.PID(cet.pid_Kc,cet.pid_Ti,cet.pid_Td
+                            ,CVlast=0.0
+                            ,Updatetime=cet.pid_updatetime
+                            ,Deadband=cet.pid_deadband
+                            )
+                    ,pvtag,sptag,cvtag
+                    )
+  return service
+
+
+async def main(args,keywords):
+  service = simulated_service(args,keywords)
+  return await service.run(float(keywords.get('duration',300.0)))
+
+
+if "__main__" == __name__:
+  args,keywords = pvp.process_args(sys.argv[1:])
+  summary = asyncio.run(main(args,keywords))
+  if 'json' in keywords:
+    with open(keywords['json'],'w') as fout: json.dump(summary,fout,indent=2)
+  json.dump(summary,sys.stdout,indent=2)
+  sys.stdout.write('\n')
@@ -0,0 +1,176 @@
+"""
+Parallel PID tuning sweep of CET.model_with_pid (see pv_predict.py)
+
+Runs one closed-loop simulation per combination of PID parameters, across
+a process pool and with no plotting (unless --plot-dir), and prints one
+table row of performance metrics per run
+
+Usage:
+
+  python pid_sweep.py [--pid-Kc=5,20,50] [--pid-Ti=8:120:8] [--pid-Td=0,1.5] \\
+                      [--pid-updatetime=45] [--fix-backlash=0,1] \\
+                      [--processes=N] [--sort=IAE] [--reverse] [--tsv] \\
+                      [--settle-band=0.05] [--event-driven] [--stats[=path]] \\
+                      [--plot-dir=DIR [--plot-format=png|svg] [--plot-points=2000]] \\
+                      [other pv_predict.py model arguments]
+
+  - Comma-separated values are lists; START:STOP:STEP are inclusive ranges
+  - --fix-backlash=0,1 (default) runs each set with and without the fix
+  - --sort is any column name in the table; rows are sorted ascending
+  - --plot-dir saves each run's plot there, rendered in the worker processes
+  - Any other --keyword=value arguments are passed to CET
+
+"""
+import os
+import sys
+import math
+import numpy as np
+import multiprocessing
+import pv_predict as pvp
+
+### Swept parameters:  CET keyword, CET attribute, table column
+sweep_keys = (('pid-Kc','pid_Kc','Kc',)
+             ,('pid-Ti','pid_Ti','Ti',)
+             ,('pid-Td','pid_Td','Td',)
+             ,('pid-updatetime','pid_updatetime','Update',)
+             ,)
+
+### Metric columns, in table order, and their output formats
+metric_columns = (('FixBL','{0:d}',)
+                 ,('IAE','{0:.4g}',)
+                 ,('ISE','{0:.4g}',)
+                 ,('Overshoot','{0:.3f}',)
+                 ,('Settling','{0:.0f}',)
+                 ,('Reversals','{0:d}',)
+                 ,('Backlash','{0:d}',)
+                 ,)
+
+def parse_grid(val):
+  """Convert 'a,b,c' list and/or 'start:stop:step' inclusive range(s) to list of floats"""
+  result = list()
+  for tok in str(val).split(','):
+    rangetoks = tok.split(':')
+    if 1 == len(rangetoks):
+      result.append(float(tok))
+      continue
+    start,stop,step = map(float,(rangetoks+['1'])[:3])
+    n = int(math.floor(((stop - start) / step) + 1e-9)) + 1
+    result.extend([start + (i * step) for i in range(n)])
+  return result
+
+
+def closed_loop_metrics(ATs,rPVs,blCVs,backlashes,setpoint,settle_band=0.05):
+  """
+  Performance metrics of one model_with_pid result, from the samples at
+  PID updates:
+  - IAE, ISE:  integrated absolute, squared error of PV vs. setpoint
+  - Overshoot:  peak PV excursion past setpoint, away from starting side
+  - Settling:  time after which |PV-SP| stays within settle_band; inf if
+               it never does
+  - Reversals:  number of direction changes of the backlashed valve
+  - Backlash:  number of PID updates where backlash held the valve
+
+  """
+  errs = rPVs - setpoint
+  dts = np.diff(ATs,append=2*ATs[-1:]-ATs[-2:-1])
+  sign = (rPVs[0] > setpoint) and -1.0 or 1.0
+  iw_out = np.where(np.abs(errs) > settle_band)[0]
+  if not len(iw_out)           : settling = 0.0
+  elif iw_out[-1]+1 < len(ATs) : settling = ATs[iw_out[-1]+1] - ATs[0]
+  else                         : settling = float('inf')
+  moves = np.sign(np.diff(blCVs))
+  moves = moves[moves != 0.0]
+  return dict(IAE=float(np.sum(np.abs(errs) * dts))
+             ,ISE=float(np.sum(errs * errs * dts))
+             ,Overshoot=max(0.0,float(np.max(sign * errs)))
+             ,Settling=float(settling)
+             ,Reversals=int(np.sum(moves[1:] != moves[:-1]))
+             ,Backlash=int(np.sum(backlashes))
+             )
+
+
+########################################################################
+### Worker process state and functions
+worker_cet,worker_keywords = None,None
+
+def init_worker(args,keywords):
+  """Create one CET, with its model data, per worker process"""
+  global worker_cet,worker_keywords
+  worker_keywords = dict(keywords)
+  worker_cet = pvp.CET(*args,**dict(keywords,**{'no-plot':True}))
+
+
+def run_one(combination):
+  """Run one closed-loop simulation; return parameters and metrics"""
+  values,fix_backlash = combination
+  for (key,attr,column,),value in zip(sweep_keys,values):
+    setattr(worker_cet,attr,value)
+  run_keywords = dict(worker_keywords)
+  run_keywords.pop('fix-backlash',None)
+  if fix_backlash: run_keywords['fix-backlash'] = True
+  (ATs,rPVs,xTts,rCVs,xCVs,blCVs,backlashes,zeroCV_ATs
+  ,) = result = worker_cet.model_with_pid(run_keywords,do_plot=False)
+  if 'plot-dir' in worker_keywords: worker_cet.plot_pid_result(result,fix_backlash)
+  row = dict(zip([column for key,attr,column in sweep_keys],values))
+  row['FixBL'] = int(fix_backlash)
+  row.update(closed_loop_metrics(ATs,rPVs,blCVs,backlashes
+                                ,worker_cet.pid_setpoint
+                                ,float(worker_keywords.get('settle-band',0.05))
+                                ))
+
+  ### Hand instrumentation results, if any, to parent; restart counts
+  if worker_cet.stats:
+    row['stats'] = worker_cet.stats.as_dict()
+    worker_cet.stats.reset()
+  return row
+
+
+########################################################################
+def sweep(args,keywords):
+  """Run all combinations of swept parameters in a process pool, return table rows"""
+  defaults = pvp.CET
+  grids = [parse_grid(keywords.get(key,getattr(defaults,'default_'+attr)))
+           for key,attr,column in sweep_keys
+          ]
+  fixval = keywords.get('fix-backlash','0,1')
+  if fixval is True: fixval = '1'
+  fixes = [bool(v) for v in parse_grid(fixval)]
+  combinations = [(values,fix,) for values in np.array(np.meshgrid(*grids,indexing='ij')).reshape(len(grids),-1).T.tolist()
+                                for fix in fixes
+                 ]
+
+  ### Hand out runs in modest chunks, so IPC overhead stays small and
+  ### slow runs do not leave other workers idle at the end
+  processes = int(keywords.get('processes',0)) or multiprocessing.cpu_count()
+  chunksize = max(1,len(combinations) // (4 * processes))
+  pool_keywords = dict([(k,v,) for k,v in keywords.items() if not (k in [key for key,attr,column in sweep_keys])])
+  with multiprocessing.Pool(processes,initializer=init_worker,initargs=(args,pool_keywords,)) as pool:
+    return list(pool.imap_unordered(run_one,combinations,chunksize=chunksize))
+
+
+def print_table(rows,sort_key='IAE',reverse=False,tsv=False,fout=sys.stdout):
+  """Write rows, sorted by sort_key column, as aligned or tab-separated table"""
+  columns = [(column,'{0:g}',) for key,attr,column in sweep_keys] + list(metric_columns)
+  rows = sorted(rows,key=lambda row:row[sort_key],reverse=reverse)
+  lines = [[column for column,fmt in columns]]
+  lines.extend([[fmt.format(row[column]) for column,fmt in columns] for row in rows])
+  if tsv:
+    for line in lines: fout.write('\t'.join(line)+'\n')
+    return
+  widths = [max([len(line[i]) for line in lines]) for i in range(len(columns))]
+  for line in lines:
+    fout.write('  '.join([tok.rjust(width) for tok,width in zip(line,widths)])+'\n')
+
+
+if "__main__" == __name__:
+  args,keywords = pvp.process_args(sys.argv[1:])
+  rows = sweep(args,keywords)
+  print_table(rows
+             ,sort_key=keywords.get('sort','IAE')
+             ,reverse='reverse' in keywords
+             ,tsv='tsv' in keywords
+             )
+  if 'stats' in keywords or pvp.do_stats:
+    stats = pvp.Stats(keywords.get('stats',os.environ.get('CET_STATS')))
+    for row in rows: stats.merge(row['stats'])
+    stats.dump()
@@ -1,15 +1,156 @@
 import os
 import sys
 import pid
+import json
 import math
+import time
+import multiprocessing
+import zipfile
+import contextlib
+import file_cache as fc
+import cet_plot
+import cet_stream
+import cet_actuator as cact
+import smith_predictor
 import numpy as np
 import traceback as tb
 import read_interleaved_XLSX as riX
 
 do_debug = 'DEBUG' in os.environ
 do_warn = 'WARN' in os.environ
+do_stats = 'CET_STATS' in os.environ
 npzs = lambda L: np.zeros(L,dtype=np.float)
 
+### Plant parameters:  CET keyword, CET attribute
+plant_keys = (('Ke-per-h','Ke_per_h',)
+             ,('kPV','kPV',)
+             ,('CVe','CVe',)
+             ,('CVe0','CVe0',)
+             ,('CVe0-Ke-frac','CVe_Ke_frac',)
+             ,('CVexponent','CVexponent',)
+             ,)
+
+### Plant parameters fitted by --fit, unless listed there, and bounds of
+### all of them; CVe0-Ke-frac is not fitted by default, because only its
+### ratio to (CVe-CVe0)**CVexponent matters
+default_fit_keys = ('Ke-per-h','kPV','CVe','CVexponent',)
+fit_bounds = {'Ke-per-h':(1e-6,10.0,)
+             ,'kPV':(0.5,1.0-1e-9,)
+             ,'CVe':(0.0,100.0,)
+             ,'CVe0':(0.0,100.0,)
+             ,'CVe0-Ke-frac':(1e-6,10.0,)
+             ,'CVexponent':(0.05,5.0,)
+             }
+
+def geometric_filter(f,k,x0,maxlog=600.0):
+  """
+  Return x[0:N+1], where x[0] = x0 and x[m+1] = k*x[m] + f[m], for the N
+  values of f; array equivalent of N iterations of that recurrence
+
+  Within each chunk, x[j+m] = k**m * (x[j] + sum(f[j+i] / k**(i+1))); the
+  chunks are short enough that k**m neither underflows nor overflows
+
+  """
+  f = np.asarray(f,dtype=np.float64)
+  N = len(f)
+  x = np.empty(N+1)
+  x[0] = x0
+  if 0.0 == k:
+    x[1:] = f
+    return x
+  M = (1.0==abs(k)) and N or max(1,int(maxlog / abs(math.log(abs(k)))))
+  for j in range(0,N,M):
+    n = min(M,N-j)
+    if k > 0.0: powers = np.exp(np.arange(1,n+1,dtype=np.float64) * math.log(k))
+    else      : powers = k ** np.arange(1,n+1,dtype=np.float64)
+    x[j+1:j+n+1] = powers * (x[j] + np.cumsum(f[j:j+n] / powers))
+  return x
+
+
+class Stats:
+  """
+  Optional instrumentation of CET runs:  wall time and number of calls
+  per stage, and event counters; enabled by the CET_STATS environment
+  variable or the --stats keyword, with the path to which to dump JSON
+  as their value (default standard error)
+
+  """
+  def __init__(self,path=None):
+    self.path = path
+    self.reset()
+
+  def reset(self):
+    self.stages,self.counts = dict(),dict()
+
+  def count(self,name,n=1):
+    self.counts[name] = self.counts.get(name,0) + int(n)
+
+  @contextlib.contextmanager
+  def stage(self,name):
+    t0 = time.perf_counter()
+    try:
+      yield
+    finally:
+      seconds,calls = self.stages.get(name,(0.0,0,))
+      self.stages[name] = (seconds + time.perf_counter() - t0,calls + 1,)
+
+  def counted(self,name,func):
+    """Wrap func to count its calls"""
+    def wrapper(*args):
+      self.count(name)
+      return func(*args)
+    return wrapper
+
+  def timed(self,name,func):
+    """Wrap func to time its calls as stage name"""
+    def wrapper(*args):
+      t0 = time.perf_counter()
+      try:
+        return func(*args)
+      finally:
+        seconds,calls = self.stages.get(name,(0.0,0,))
+        self.stages[name] = (seconds + time.perf_counter() - t0,calls + 1,)
+    return wrapper
+
+  def as_dict(self):
+    return dict(stages=dict([(name,dict(seconds=seconds,calls=calls),)
+                             for name,(seconds,calls,) in self.stages.items()
+                            ])
+               ,counts=dict(self.counts)
+               )
+
+  def merge(self,other):
+    """Add counts and times from other, a Stats.as_dict() result"""
+    for name,stage in other['stages'].items():
+      seconds,calls = self.stages.get(name,(0.0,0,))
+      self.stages[name] = (seconds + stage['seconds'],calls + stage['calls'],)
+    for name,n in other['counts'].items(): self.count(name,n)
+
+  def dump(self,path=None):
+    path = path or self.path
+    if isinstance(path,str) and path:
+      with open(path,'w') as fout: json.dump(self.as_dict(),fout,indent=2)
+    else:
+      json.dump(self.as_dict(),sys.stderr,indent=2)
+      sys.stderr.write('\n')
+
+
+### Cache of .model_with_pid results (--result-cache):  default directory,
+### next to this file, and default size limit of all cached files there
+result_cache_dirname = os.path.join(os.path.dirname(os.path.abspath(__file__)),'.cet_result_cache')
+result_cache_max_bytes = 256 << 20
+result_cache_version = 1
+result_names = ('ATs','rPVs','xTts','rCVs','xCVs','blCVs','backlashes','zeroCV_ATs',)
+
+### Stand-in for Stats.stage when instrumentation is off
+nostage = contextlib.nullcontext()
+
+
+def loaded_data(name):
+  """CET property of model data attribute ._name, read on first use"""
+  return property(lambda self: self.load_data() or getattr(self,'_'+name))
+
+
 class CET:  ### Chilled Exothermic Tank
   """
 Model temperature of PV sensor in tank with exothermic media and cooled
@@ -68,6 +209,23 @@ Model
     self.kPV = float(keywords.get('kPV',self.default_kPV))
     self.model_time_step = float(keywords.get('model-time-step',self.default_time_step))
     self.do_plot = not keywords.get('no-plot',False)
+    self.plot_dir = keywords.get('plot-dir',None)
+    self.plot_format = keywords.get('plot-format','png')
+    self.plot_points = int(keywords.get('plot-points',cet_plot.default_npoints))
+    self.vectorized_replay = keywords.get('vectorized-replay',False)
+    self.replay_plan_key = None
+    self.result_cache = keywords.get('result-cache',False)
+    if self.result_cache is True: self.result_cache = result_cache_dirname
+    self.result_cache_bytes = int(keywords.get('result-cache-bytes',result_cache_max_bytes))
+
+    ### Instrumentation, off unless requested; when on, count
+    ### .calculate_CVscalar calls by wrapping it, so it costs nothing
+    ### when off
+    if 'stats' in keywords or do_stats:
+      self.stats = Stats(keywords.get('stats',os.environ.get('CET_STATS')))
+      self.calculate_CVscalar = self.stats.counted('calculate_CVscalar',self.calculate_CVscalar)
+    else:
+      self.stats = None
 
     self.pid_Kc = float(keywords.get('pid-Kc',self.default_pid_Kc))
     self.pid_Ti = float(keywords.get('pid-Ti',self.default_pid_Ti))
@@ -77,27 +235,54 @@ Model
     self.pid_setpoint = float(keywords.get('pid-setpoint',self.default_pid_setpoint))
     self.pid_duration = float(keywords.get('pid-duration',self.default_pid_duration))
 
-    ### Model data from XLSX
-    self.path = None
-    for arg in args+self.default_pathv:
-      try:
-        assert self.path is None
-        self.ats,self.cvs,self.pvs = riX.read_XLSX(arg)
-        self.path = arg
-        break
-      except:
-        if do_debug: tb.print_exc()
-        if do_warn:
-          sys.stderr.write('WARNING:  ignoring unknown argument [{0}]\n'.format(arg))
+    ### Model data from XLSX, read on first use of .path, .ats, .cvs or
+    ### .pvs, so runs that do not need it (e.g. --no-model-data) skip it
+    self.data_args = args
+    self.xlsx_cache = not keywords.get('no-xlsx-cache',False)
+    self.data_loaded = False
 
     self.calculate_per_timestep_parameters()
 
+  def load_data(self):
+    """Read model data from first readable XLSX argument, first call only"""
+    if self.data_loaded: return
+    self.data_loaded,self._path = True,None
+    with self.stage('load_data'):
+      for arg in self.data_args+self.default_pathv:
+        try:
+          assert self._path is None
+          if self.xlsx_cache:
+            self._ats,self._cvs,self._pvs = riX.read_XLSX_cached(arg)
+          else:
+            self._ats,self._cvs,self._pvs = riX.read_XLSX(arg)
+          self._path = arg
+          break
+        except:
+          if do_debug: tb.print_exc()
+          if do_warn:
+            sys.stderr.write('WARNING:  ignoring unknown argument [{0}]\n'.format(arg))
+
+  path = loaded_data('path')
+  ats = loaded_data('ats')
+  cvs = loaded_data('cvs')
+  pvs = loaded_data('pvs')
+
+  def stage(self,name):
+    """Context manager timing stage name, if instrumentation is on"""
+    return self.stats and self.stats.stage(name) or nostage
+
+  def dump_stats(self,path=None):
+    """Write instrumentation results as JSON, if instrumentation is on"""
+    if self.stats: self.stats.dump(path)
+
   def calculate_per_timestep_parameters(self):
     ### Convert model parameter inputs to per-timestep values
     ### - .Ke - temperature rise per timestep, exotherm-only, no cooling
     ### - .kPV_step - per-timestep PV decay, (PVn-Tt)/(PV<n-1>-Tt)
     self.Ke = self.Ke_per_h * self.model_time_step / 3600.0
     self.kPV_step = self.kPV**self.model_time_step
+    ### - .cooling_curve - CVscalar of each whole-percentage valve position
+    self.cooling_curve = cact.CoolingCurve(self.calculate_CVscalar)
 
   def model_one_timestep(self,AT,Tt,PV,CVscalar):
     retTt = Tt + CVscalar
@@ -105,7 +290,40 @@ Model
     retAT = AT + self.model_time_step
     return retAT,retTt,retPV
 
+  def model_n_timesteps(self,AT,Tt,PV,CVscalar,nsteps):
+    """
+    Closed-form equivalent of nsteps calls to .model_one_timestep with
+    constant CVscalar:  Tt rises linearly; the PV-Tt difference decays
+    geometrically, by .kPV_step per step, toward its fixed point
+
+    """
+    retTt = Tt + (nsteps * CVscalar)
+    if 1.0 == self.kPV_step:
+      retPV = retTt + (PV - Tt) + (nsteps * (self.Ke - CVscalar))
+    else:
+      fixedpoint = (self.Ke - (self.kPV_step * CVscalar)) / (1.0 - self.kPV_step)
+      retPV = retTt + fixedpoint + ((PV - Tt - fixedpoint) * self.kPV_step**nsteps)
+    retAT = self.step_ATs(AT,nsteps)[-1]
+    return retAT,retTt,retPV
+
+  def step_ATs(self,AT,nsteps):
+    """
+    Times after each of nsteps model time steps from AT, accumulated one
+    step at a time as .model_one_timestep does, so they match it to the
+    last bit even when .model_time_step does not divide the interval
+
+    """
+    return np.cumsum(np.concatenate(([AT],np.full(nsteps,self.model_time_step))))[1:]
+
+  def steps_until(self,AT,untilAT):
+    """Number of model time steps from AT to first step time at or after untilAT"""
+    n = max(1,int(math.ceil((untilAT - AT) / self.model_time_step)) + 2)
+    return int(np.searchsorted(self.step_ATs(AT,n),untilAT,side='left')) + 1
+
   def calculate_CVscalar(self,CV):
+    ### CVe at or below CVe0 has no cooling curve above CVe0:  NaN there,
+    ### rather than complex values or ZeroDivisionError, e.g. for --fit
+    if CV > self.CVe0 and self.CVe <= self.CVe0: return float('nan')
     if CV > self.CVe0: return self.Ke * (1.0 - (self.CVe_Ke_frac * ((CV - self.CVe0) / (self.CVe - self.CVe0))**self.CVexponent))
     return self.Ke
 
@@ -117,37 +335,155 @@ Model
     else                     :
       blCV = lastblCV
       backlash = True
-    return blCV,rounded0_CV,xCV,self.calculate_CVscalar(blCV),backlash
-
-  def model_data(self,do_plot=None):
-
-    ### Select start point from raw data
+    return blCV,rounded0_CV,xCV,self.cooling_curve.step(blCV)[0],backlash
+
+  def xCVs_to_CVs(self,xCVs,lastblCV=-1e32):
+    """
+    Array equivalent of chained .xCV_to_CV calls over xCVs, starting from
+    lastblCV; returns backlashed CVs and backlash flags
+
+    """
+    rounded0_CVs,events = cact.Quantize().apply(xCVs)
+    return cact.Backlash(lastblCV).apply(rounded0_CVs,events)
+
+  def calculate_CVscalars(self,CVs):
+    """Array equivalent of .calculate_CVscalar, by .cooling_curve lookup"""
+    return self.cooling_curve.apply(CVs)[0]
+
+  def make_actuator(self,fix_backlash=False):
+    """
+    Valve from PID CV to CVscalar (see cet_actuator.py):  whole-percentage
+    rounding, backlash, and with fix_backlash two model time steps at 0%
+    after each backlash event; override, or pass an Actuator to
+    .model_with_pid, to model other valves
+
+    """
+    stages = [cact.Quantize(),cact.Backlash()]
+    if fix_backlash: stages.append(cact.CompensationPulse(2,0.0))
+    return cact.Actuator(stages,self.cooling_curve)
+
+  def replay_inputs(self):
+    """Select start point from raw data; return model inputs and initial state"""
     i0 = np.where(np.bitwise_and(self.cvs==self.init_CV,self.pvs==self.init_temp))[0][0]-1
 
     ### Get model inputs
     pATs,pCVs = self.ats[i0:],self.cvs[i0:]
 
-    ### Create predicted data arrays
-    L = len(pATs)
-    pPVs,pTts,pblCVs = npzs(L),npzs(L),npzs(L)
-
     ### Get Present Value from model
     pPV = self.pvs[i0:i0+2].mean()
     ### Assuming pPV is steady at one value
     pTt = pPV - (self.Ke / (1.0 - self.kPV_step))
 
+    return i0,pATs,pCVs,pPV,pTt
+
+  def replay_loop(self):
+    """Replay recorded CVs through model, one time step per iteration"""
+    i0,pATs,pCVs,pPV,pTt = self.replay_inputs()
+
+    ### Create predicted data arrays
+    L = len(pATs)
+    pPVs,pTts,pblCVs = npzs(L),npzs(L),npzs(L)
+
     ### Initialize model
-    AT,inext,blCV = pATs[0],0,-1e32
+    AT,inext = pATs[0],0
+    actuator = self.make_actuator()
 
     while True:
       if AT>=pATs[inext]:
-        blCV,rCV,xCV,CVscalar,backlash = self.xCV_to_CV(pCVs[inext],blCV)
+        blCV,rCV,xCV,CVscalar,backlash,transients = actuator.command(pCVs[inext])
         pPVs[inext],pTts[inext],pblCVs[inext] = pPV,pTt,blCV
         inext += 1
         if inext>=L: break
 
       AT,pTt,pPV = self.model_one_timestep(AT,pTt,pPV,CVscalar)
 
+    return pATs,pPVs,pTts,pblCVs
+
+  def replay_plan(self):
+    """
+    Parts of .replay_arrays that do not depend on plant parameters:
+    start index, sample times, backlashed CVs, and model step at which
+    each sample is ingested; calculated once per start point and time step
+
+    """
+    key = (self.model_time_step,self.init_CV,self.init_temp,)
+    if key != self.replay_plan_key:
+      i0,pATs,pCVs,pPV,pTt = self.replay_inputs()
+      L = len(pATs)
+
+      ### Backlashed CVs
+      pblCVs,backlashes,CVscalars = self.make_actuator().apply(pCVs)
+
+      ### Model step at which each sample is ingested:  first step at or
+      ### after its time, and at most one sample per step; step times are
+      ### accumulated as in the loop, so they match it to the last bit
+      aL = np.arange(L)
+      Nmax = int(math.ceil((pATs[-1] - pATs[0]) / self.model_time_step)) + L + 1
+      stepATs = np.cumsum(np.concatenate(([pATs[0]],np.full(Nmax,self.model_time_step))))
+      isteps = np.searchsorted(stepATs,pATs,side='left')
+      isteps = np.maximum.accumulate(isteps - aL) + aL
+
+      self.replay_plan_key,self.replay_plan_value = key,(i0,pATs,pPV,pblCVs,isteps,)
+    return self.replay_plan_value
+
+  def replay_arrays(self):
+    """
+    Replay recorded CVs through model with array operations; same result
+    as .replay_loop, to floating-point tolerance
+
+    """
+    i0,pATs,pPV,pblCVs,isteps = self.replay_plan()
+    ### Assuming pPV is steady at one value, as in .replay_inputs
+    pTt = pPV - (self.Ke / (1.0 - self.kPV_step))
+
+    ### Per-step CVscalars, from CVscalar in effect after each sample; Tt
+    ### is their running sum, and PV-Tt follows a first-order linear
+    ### recurrence with constant coefficient .kPV_step
+    stepCVscalars = np.repeat(self.cooling_curve.apply(pblCVs[:-1])[0],np.diff(isteps))
+    Tts = np.cumsum(np.concatenate(([pTt],stepCVscalars)))
+    PVmTts = geometric_filter(self.Ke - (self.kPV_step * stepCVscalars)
+                             ,self.kPV_step,pPV - pTt)
+    pTts = Tts[isteps]
+    pPVs = pTts + PVmTts[isteps]
+
+    return pATs,pPVs,pTts,pblCVs
+
+  def iter_replay(self,block_size=cet_stream.default_block_size):
+    """
+    Generator:  .replay_arrays, yielding (pATs,pPVs,pTts,pblCVs) in blocks
+    of block_size samples, with per-step arrays no longer than the model
+    steps of one block; see cet_stream.py
+
+    """
+    i0,pATs,pPV,pblCVs,isteps = self.replay_plan()
+    pTt = pPV - (self.Ke / (1.0 - self.kPV_step))
+    pPVmTt = pPV - pTt
+    L = len(pATs)
+    for j in range(0,L,int(block_size)):
+      k = min(L,j+int(block_size))
+      ### Steps from sample j to sample k (or to the last sample)
+      kend = min(L-1,k)
+      stepCVscalars = np.repeat(self.cooling_curve.apply(pblCVs[j:kend])[0],np.diff(isteps[j:kend+1]))
+      Tts = np.cumsum(np.concatenate(([pTt],stepCVscalars)))
+      PVmTts = geometric_filter(self.Ke - (self.kPV_step * stepCVscalars)
+                               ,self.kPV_step,pPVmTt)
+      iblock = isteps[j:k] - isteps[j]
+      pTts = Tts[iblock]
+      yield pATs[j:k],pTts + PVmTts[iblock],pTts,pblCVs[j:k]
+      pTt,pPVmTt = Tts[-1],PVmTts[-1]
+
+  def model_data(self,do_plot=None,vectorized=None):
+    """Replay recorded CVs through model; plot against recorded PVs"""
+    with self.stage('model_data'):
+      if self.vectorized_replay if (None is vectorized) else vectorized:
+        pATs,pPVs,pTts,pblCVs = self.replay_arrays()
+      else:
+        pATs,pPVs,pTts,pblCVs = self.replay_loop()
+
+    if self.stats:
+      self.stats.count('replay_samples',len(pATs))
+      self.stats.count('replay_timesteps',math.ceil((pATs[-1] - pATs[0]) / self.model_time_step))
+
     if self.do_plot if (None is do_plot) else do_plot:
       pvtitle = '{0}\nKe={1}deg/h kPV={2} CVe0/CVe/CVexp/KeFrac@CVe={3}/{4}/{5}/{6}'.format(
                 os.path.basename(self.path)
@@ -172,6 +508,7 @@ Model
                                         ,(pPVs,'PV Predict',)
                                         ,)
                      ,)
+                    ,name='data',params=self.plant_params()
                     )
     #if None is CVs:
     #  pvplt.plot(self.ats,self.pvs,label='PV Data')
@@ -183,55 +520,146 @@ Model
     #else:
     #  cvplt.plot(ATs,CVs,linewidth=0.5)
 
-  def plot_data(self,*args):
-    import matplotlib.pyplot as plt
-
-    fig,(pvplt,cvplt) = plt.subplots(nrows=2,ncols=1
-                                    ,sharex=True
-                                    ,gridspec_kw=dict(height_ratios=[3,1])
-                                    )
-
-    pvplt.axhline(12.0,label='SP',linewidth=0.5,linestyle='dotted')
-    pvplt.set_ylabel('Temperature, degC')
-    #pvplt.set_title(title)
-    cvplt.set_ylabel('CV, %')
-    cvplt.set_xlabel('Time, s')
-
-    for ats,whichplot,xvtitle,xvpairs in args:
-      xvplt = whichplot.startswith('CV') and cvplt or pvplt
-      markerline = whichplot.endswith('dots') and '.' or '-'
-      if isinstance(xvtitle,str): xvplt.set_title(xvtitle)
-      for xvs,xvlegend in xvpairs:
-        sys.stdout.flush()
-        xvplt.plot(ats,xvs
-                  ,markerline
-                  ,label=xvlegend
-                  ,linewidth='Backlash CV' == xvlegend and 0.5 or None
-                  ,markersize=0.5
-                  )
-      xvplt.legend(loc=xvplt is cvplt and 'center right' or 'best')
+    return pATs,pPVs,pTts,pblCVs
+
+  def plot_data(self,*args,**keywords):
+    """
+    Plot args, sequence of (ats,whichplot,xvtitle,xvpairs), decimated to
+    .plot_points per series (see cet_plot.py); with --plot-dir, save to
+    file there, named from keywords name and params, instead of showing
+
+    """
+    with self.stage('plot'):
+      if self.plot_dir:
+        os.makedirs(self.plot_dir,exist_ok=True)
+        return cet_plot.save(os.path.join(self.plot_dir
+                                         ,cet_plot.figure_name(keywords.get('name','cet')
+                                                              ,keywords.get('params',())
+                                                              ,self.plot_format
+                                                              )
+                                         )
+                            ,args,self.plot_points,self.pid_setpoint
+                            )
+      cet_plot.show(args,self.plot_points,self.pid_setpoint)
+
+  def set_plant(self,**values):
+    """Set plant parameters from CET keywords (see plant_keys)"""
+    for key,attr in plant_keys:
+      if key in values: setattr(self,attr,float(values[key]))
+    self.calculate_per_timestep_parameters()
 
-    #if None is CVs:
-    #  pvplt.plot(self.ats,self.pvs,label='PV Data')
-    #pvplt.plot(ATs,PVs,label='PV Predict')
-    #pvplt.plot(ATs,Tts,label='Tank Predict')
+  def plant_keywords(self):
+    """Plant parameters, as dict of CET keywords"""
+    return dict([(key,getattr(self,attr),) for key,attr in plant_keys])
+
+  def replay_residuals(self):
+    """Model PVs, replayed with array operations, less recorded PVs"""
+    pATs,pPVs,pTts,pblCVs = self.replay_arrays()
+    return pPVs - self.pvs[self.replay_plan()[0]:]
+
+  def plant_params(self):
+    """Plant parameters, as (name,value) pairs, for plot file names"""
+    return (('Ke',self.Ke_per_h,),('kPV',self.kPV,),('CVe0',self.CVe0,)
+           ,('CVe',self.CVe,),('CVexp',self.CVexponent,),('KeFrac',self.CVe_Ke_frac,)
+           ,)
+
+  def model_with_pid(self,keywords,do_plot=None,actuator=None):
+    """
+    Closed-loop PID simulation; actuator, if given, replaces the valve of
+    .make_actuator (see cet_actuator.py)
+
+    """
+    with self.stage('model_with_pid'):
+      if self.result_cache and (None is actuator): result = self.cached_simulate_with_pid(keywords)
+      else                                       : result = self.simulate_with_pid(keywords,actuator)
+
+    if self.stats:
+      ATs,rPVs,xTts,rCVs,xCVs,blCVs,backlashes,zeroCV_ATs = result
+      self.stats.count('timesteps',round(self.last_AT / self.model_time_step))
+      self.stats.count('pid_updates',len(ATs))
+      self.stats.count('backlash_events',backlashes.sum())
+      self.stats.count('zeroing_steps',len(zeroCV_ATs))
+      ### Each fix-backlash pulse follows a backlash event, except one at
+      ### the final PID update, which ends the simulation
+      if 'fix-backlash' in keywords:
+        self.stats.count('zeroing_pulses',backlashes[:-1].sum())
 
-    #if None is CVs:
-    #  cvplt.plot(self.ats,self.cvs,linewidth=0.5)
-    #else:
-    #  cvplt.plot(ATs,CVs,linewidth=0.5)
-
-    #if isinstance(cvtitle,str): cvplt.set_title(cvtitle)
+    if self.do_plot if (None is do_plot) else do_plot:
+      self.plot_pid_result(result,'fix-backlash' in keywords,keywords.get('smith',None))
+
+    return result
+
+  def result_key(self,keywords):
+    """
+    Cache key of .model_with_pid result:  all model, PID and run
+    parameters, and class, as subclasses may model other valves
+
+    """
+    return fc.key_digest(result_cache_version,type(self).__module__,type(self).__name__
+                        ,sorted(self.plant_keywords().items()),self.model_time_step
+                        ,self.pid_Kc,self.pid_Ti,self.pid_Td,self.pid_updatetime
+                        ,self.pid_deadband,self.pid_setpoint,self.pid_duration
+                        ,'fix-backlash' in keywords,'event-driven' in keywords
+                        ,('smith' in keywords) and parse_smith(keywords['smith']) or None
+                        )
+
+  def cached_simulate_with_pid(self,keywords):
+    """
+    Same as .simulate_with_pid, via an on-disk cache of its result
+
+    The result arrays, and the last model time, are saved uncompressed
+    in one .npz file in directory .result_cache, named by .result_key,
+    written atomically so worker processes can share the cache; after
+    each write, least-recently-used files are evicted until the cache
+    holds at most .result_cache_bytes.  A cache that cannot be read or
+    written is ignored
+
+    """
+    cache_path = os.path.join(self.result_cache,self.result_key(keywords)+'.npz')
+    try:
+      with np.load(cache_path) as npz:
+        result = tuple([npz[name] for name in result_names])
+        self.last_AT = float(npz['last_AT'])
+      fc.touch(cache_path)
+      if self.stats: self.stats.count('result_cache_hits')
+      return result[:-1] + (result[-1].tolist(),)
+    except (OSError,ValueError,KeyError,zipfile.BadZipFile):
+      pass
+
+    if self.stats: self.stats.count('result_cache_misses')
+    result = self.simulate_with_pid(keywords)
+    arrays = dict(zip(result_names,result),last_AT=self.last_AT)
+    try:
+      os.makedirs(self.result_cache,exist_ok=True)
+      fc.atomic_save(cache_path,lambda fout:np.savez(fout,**arrays))
+      fc.evict(self.result_cache,self.result_cache_bytes,suffix='.npz',keep=(cache_path,))
+    except OSError as e:
+      sys.stderr.write('WARNING:  not caching result [{0}]:  {1}\n'.format(cache_path,e))
+    return result
+
+  def simulate_with_pid(self,keywords,actuator=None):
+    """Closed-loop PID simulation; see .model_with_pid"""
+    L = int(math.ceil(self.pid_duration / self.pid_updatetime))
+    return list(self.iter_with_pid(keywords,actuator,L))[0]
 
-    plt.show()
+  def iter_with_pid(self,keywords,actuator=None,block_size=cet_stream.default_block_size):
+    """
+    Generator:  closed-loop PID simulation, as .simulate_with_pid, yielding
+    its result in blocks of block_size PID updates (the last one may be
+    shorter), each with the zeroCV_ATs of its updates; see cet_stream.py
 
-  def model_with_pid(self,keywords,do_plot=None):
+    """
     L = int(math.ceil(self.pid_duration / self.pid_updatetime))
-    (ATs,rPVs,xTts,rCVs,blCVs,xCVs
-    ,) = npzs(L),npzs(L),npzs(L),npzs(L),npzs(L),npzs(L)
+    B = min(L,int(block_size))
+    newblock = lambda: (npzs(B),npzs(B),npzs(B),npzs(B),npzs(B),npzs(B),np.zeros(B,dtype=bool),list(),)
+    (ATs,rPVs,xTts,rCVs,blCVs,xCVs,backlashes,zeroCV_ATs
+    ,) = newblock()
     AT,xPV,xTt,xCV = 0.0,11.80,11.80,0.0
+    iblock = 0
 
-    nextPIDAT,inext,blCV = 0.0,0,-1e32
+    nextPIDAT,inext = 0.0,0
+    if None is actuator: actuator = self.make_actuator('fix-backlash' in keywords)
+    actuator.reset()
 
     ctlpid = pid.PID(self.pid_Kc,self.pid_Ti,self.pid_Td
                     ,CVlast=xCV
@@ -239,68 +667,189 @@ Model
                     ,Deadband=self.pid_deadband
                     )
 
-    zeroCV_ATs = list()
+    ### --smith=k,t0,t1,c,dt:  wrap PID in Smith predictor with that
+    ### SOPDT model, e.g. SmithPredictor/SysID_SOPDT.py go_main result
+    if 'smith' in keywords:
+      ctlpid = smith_predictor.SmithPredictor(ctlpid,*parse_smith(keywords['smith']))
+
+    ### --event-driven:  between PID updates, and outside transients such
+    ### as fix-backlash pulses, CVscalar is constant, so jump straight to
+    ### next event
+    event_driven = 'event-driven' in keywords
+
+    ### With instrumentation on, PID and valve time apart from model steps
+    control,command = ctlpid.control,actuator.command
+    one_timestep,n_timesteps = self.model_one_timestep,self.model_n_timesteps
+    if self.stats:
+      control,command = self.stats.timed('pid_control',control),self.stats.timed('actuator_command',command)
+      one_timestep = self.stats.timed('model_one_timestep',one_timestep)
+      n_timesteps = self.stats.timed('model_n_timesteps',n_timesteps)
 
     while True:
       rPV = round(xPV,2)
 
       if AT >= nextPIDAT:
-        xCV = ctlpid.control(rPV,self.pid_setpoint)
-        blCV,rCV,xCV,CVscalar,backlash = self.xCV_to_CV(xCV,blCV)
-        """
-        xCV = ctlpid.control(rPV,self.pid_setpoint)
-        rCV = round(xCV,0)
-        if rCV > blCV  : blCV = rCV
-        elif rCV <= 0.0: blCV = 0.0
-        if blCV != lxastblCV:
-          CVscalar = self.calculate_CVscalar(blCV)
-          lxastblCV = blCV
-        """
-        (ATs[inext],rPVs[inext],xTts[inext]
-        ,rCVs[inext],xCVs[inext],blCVs[inext]
-        ,) = AT,rPV,xTt,rCV,xCV,blCV
+        xCV = control(rPV,self.pid_setpoint)
+        blCV,rCV,xCV,CVscalar,backlash,transients = command(xCV)
+        if iblock == B:
+          yield ATs,rPVs,xTts,rCVs,xCVs,blCVs,backlashes,zeroCV_ATs
+          (ATs,rPVs,xTts,rCVs,blCVs,xCVs,backlashes,zeroCV_ATs
+          ,) = newblock()
+          iblock = 0
+        (ATs[iblock],rPVs[iblock],xTts[iblock]
+        ,rCVs[iblock],xCVs[iblock],blCVs[iblock],backlashes[iblock]
+        ,) = AT,rPV,xTt,rCV,xCV,blCV,backlash
+        iblock += 1
         inext += 1
         if inext >= L: break
         nextPIDAT = AT + self.pid_updatetime
 
-        blrem = ('fix-backlash' in keywords) and backlash and 3 or 0
+      ### Transient valve segments, e.g. fix-backlash pulses, one model
+      ### time step at a time
+      if transients:
+        transientCVscalar,nleft = transients[0]
+        zeroCV_ATs.append(AT)
+        AT,xTt,xPV = one_timestep(AT,xTt,xPV,transientCVscalar)
+        if nleft > 1: transients[0] = (transientCVscalar,nleft-1,)
+        else        : transients.pop(0)
+        continue
+
+      if event_driven:
+        nsteps = self.steps_until(AT,nextPIDAT)
+        if nsteps > 1:
+          AT,xTt,xPV = n_timesteps(AT,xTt,xPV,CVscalar,nsteps)
+          continue
+
+      AT,xTt,xPV = one_timestep(AT,xTt,xPV,CVscalar)
+
+    self.last_AT = AT
+    if iblock < B:
+      (ATs,rPVs,xTts,rCVs,xCVs,blCVs,backlashes
+      ,) = ATs[:iblock],rPVs[:iblock],xTts[:iblock],rCVs[:iblock],xCVs[:iblock],blCVs[:iblock],backlashes[:iblock]
+    yield ATs,rPVs,xTts,rCVs,xCVs,blCVs,backlashes,zeroCV_ATs
+
+  def plot_pid_result(self,result,fix_backlash=False,smith=None):
+    """Plot .model_with_pid result; smith is --smith value, if any"""
+    ATs,rPVs,xTts,rCVs,xCVs,blCVs,backlashes,zeroCV_ATs = result
+    pvtitle = 'Ke={0}deg/h kPV={1} CVe0={2} CVe={3} CVexp={4}'.format(
+              self.Ke_per_h
+              ,self.kPV
+              ,self.CVe0
+              ,self.CVe
+              ,self.CVexponent
+              )
+    cvtitle = 'Kc={0} Ti={1}min Td={2}min Update={3}s'.format(
+              self.pid_Kc
+              ,self.pid_Ti
+              ,self.pid_Td
+              ,self.pid_updatetime
+              #,self.pid_deadband
+              )
+    if smith: cvtitle += ' Smith={0}'.format(','.join(['{0:g}'.format(v) for v in parse_smith(smith)]))
+    self.plot_data((ATs,'CV',cvtitle,((rCVs,'Rounded CV',)
+                                     ,(blCVs,'Backlash CV',)
+                                     ,)
+                   ,)
+                  ,(ATs,'PV',pvtitle,((xTts,'Tank Predict',)
+                                     ,(rPVs,'PV Predict',)
+                                     ,)
+                   ,)
+                  ,(zeroCV_ATs,'CVdots',None,(([0.0]*len(zeroCV_ATs),'CV zeroed',)
+                                            ,)
+                   ,)
+                  ,name=smith and 'smith' or 'pid'
+                  ,params=(('Kc',self.pid_Kc,),('Ti',self.pid_Ti,),('Td',self.pid_Td,)
+                          ,('Update',self.pid_updatetime,),('FixBL',int(fix_backlash),)
+                          ,)+self.plant_params()
+                  )
 
-      if blrem > 0:
-        blrem -= 1
-        if blrem:
-          blCV,rCVtmp,xCVtmp,CVscalar,backlashtmp = self.xCV_to_CV(0.0,0.0)
-          zeroCV_ATs.append(AT)
-        else    : blCV,rCVtmp,xCVtmp,CVscalar,backlashtmp = self.xCV_to_CV(xCV,blCV)
 
-      AT,xTt,xPV = self.model_one_timestep(AT,xTt,xPV,CVscalar)
+########################################################################
+### Plant parameter fitting; worker process state and functions
+fit_cet = None
 
-    if self.do_plot if (None is do_plot) else do_plot:
-      pvtitle = 'Ke={0}deg/h kPV={1} CVe0={2} CVe={3} CVexp={4}'.format(
-                self.Ke_per_h
-                ,self.kPV
-                ,self.CVe0
-                ,self.CVe
-                ,self.CVexponent
-                )
-      cvtitle = 'Kc={0} Ti={1}min Td={2}min Update={3}s'.format(
-                self.pid_Kc
-                ,self.pid_Ti
-                ,self.pid_Td
-                ,self.pid_updatetime
-                #,self.pid_deadband
-                )
-      self.plot_data((ATs,'CV',cvtitle,((rCVs,'Rounded CV',)
-                                       ,(blCVs,'Backlash CV',)
-                                       ,)
-                     ,)
-                    ,(ATs,'PV',pvtitle,((xTts,'Tank Predict',)
-                                       ,(rPVs,'PV Predict',)
-                                       ,)
-                     ,)
-                    ,(zeroCV_ATs,'CVdots',None,(([0.0]*len(zeroCV_ATs),'CV zeroed',)
-                                              ,)
-                     ,)
-                    )
+def init_fit_worker(args,keywords):
+  """Create one CET, with its model data, per worker process"""
+  global fit_cet
+  fit_cet = CET(*args,**dict(keywords,**{'no-plot':True}))
+
+
+def plant_residuals(cet,keys,values):
+  """Replay residuals with plant parameters keys set to values"""
+  cet.set_plant(**dict(zip(keys,values)))
+  with np.errstate(all='ignore'): residuals = cet.replay_residuals()
+  ### Parameters off the valid range (e.g. CVe <= CVe0) give NaN or inf
+  ### residuals; keep the cost finite
+  return np.where(np.isfinite(residuals),residuals,1e3)
+
+
+def fit_residuals(job):
+  """Worker:  plant_residuals of job, (keys,values)"""
+  return plant_residuals(fit_cet,*job)
+
+
+def fit_plant(cet,args,keywords):
+  """
+  Least-squares fit of plant parameters to the recorded PVs, with the
+  array replay of .model_data as the model, from the parameters of cet;
+  args and keywords are those of cet, to build one CET per worker.
+
+  --fit=KEY,KEY... lists the CET keywords to fit (default_fit_keys);
+  --processes=N sets the number of worker processes (default CPU count),
+  which evaluate the finite-difference Jacobian columns in parallel.
+
+  Sets cet to the fitted parameters; returns dict of fitted CET keywords
+  and dict of residual statistics (PV units), with standard errors of
+  the fitted parameters estimated from the Jacobian
+
+  """
+  from scipy.optimize import least_squares
+  assert not (None is cet.path),'No recorded data to fit'
+  fitval = keywords.get('fit',True)
+  keys = (fitval is True) and list(default_fit_keys) or fitval.split(',')
+  plant = cet.plant_keywords()
+  assert not [key for key in keys if not (key in plant)],'Unknown plant parameter(s) in [{0}]'.format(fitval)
+  lo,hi = np.array([fit_bounds[key] for key in keys]).T
+  x0 = np.clip([plant[key] for key in keys],lo,hi)
+
+  processes = int(keywords.get('processes',0)) or multiprocessing.cpu_count()
+  pool = (processes > 1) and multiprocessing.Pool(processes,initializer=init_fit_worker
+                                                 ,initargs=(args,keywords,))
+  residuals = lambda x: plant_residuals(cet,keys,x)
+
+  def jacobian(x):
+    """Forward differences, one parameter per job, stepping away from bounds"""
+    hs = np.sqrt(np.finfo(np.float64).eps) * np.maximum(np.abs(x),1e-3)
+    hs = np.where(x + hs > hi,-hs,hs)
+    jobs = [(keys,x + (h * np.eye(len(x))[i]),) for i,h in enumerate(hs)]
+    if pool: rs = pool.map(fit_residuals,jobs)
+    else   : rs = [plant_residuals(cet,*job) for job in jobs]
+    r0 = residuals(x)
+    return np.array([(r - r0) / h for r,h in zip(rs,hs)]).T
+
+  try:
+    with cet.stage('fit'):
+      result = least_squares(residuals,x0,jac=jacobian,bounds=(lo,hi),x_scale='jac')
+  finally:
+    if pool: pool.close()
+
+  fitted = dict(zip(keys,map(float,result.x)))
+  cet.set_plant(**fitted)
+  r = cet.replay_residuals()
+  n,p = len(r),len(keys)
+  sse = float(np.sum(r * r))
+  stderrs = np.sqrt(np.diag(np.linalg.pinv(result.jac.T.dot(result.jac))) * sse / max(1,n-p))
+  stats = dict(samples=n,sse=sse,rms=float(np.sqrt(sse / n))
+              ,mean=float(r.mean()),std=float(r.std()),max_abs=float(np.abs(r).max())
+              ,nfev=int(result.nfev),njev=int(result.njev or 0),status=int(result.status)
+              ,stderr=dict(zip(keys,map(float,stderrs)))
+              )
+  return fitted,stats
+
+
+def parse_smith(val):
+  """Parse 'k,t0,t1,c,dt' or '[k t0 t1 c dt]' SOPDT model to list of floats"""
+  return list(map(float,val.strip().lstrip('([').rstrip('])').replace(',',' ').split()))
 
 
 def process_args(argv):
@@ -318,7 +867,27 @@ def process_args(argv):
 if "__main__" == __name__:
   args,keywords = process_args(sys.argv[1:])
   cet = CET(*args,**keywords)
-  if not ('no-model-data' in keywords):
-    cet.model_data()
-  if not ('no-model-pid' in keywords):
-    cet.model_with_pid(keywords)
+  if 'fit' in keywords:
+    fitted,fitstats = fit_plant(cet,args,keywords)
+    json.dump(fitstats,sys.stdout,indent=2)
+    sys.stdout.write('\n{0}\n'.format(' '.join(['--{0}={1:.6g}'.format(key,value) for key,value in fitted.items()])))
+  if 'stream' in keywords:
+    ### --stream[=PREFIX]:  results in blocks, to PREFIX_data.tsv and
+    ### PREFIX_pid.tsv if given; print summaries, no plots
+    prefix = None if keywords['stream'] is True else keywords['stream']
+    block_size = int(keywords.get('block-size',cet_stream.default_block_size))
+    summaries = dict()
+    if not ('no-model-data' in keywords):
+      summaries['data'] = cet_stream.stream(cet.iter_replay(block_size),('ATs','PVs','Tts','blCVs',)
+                                           ,prefix and prefix+'_data.tsv')
+    if not ('no-model-pid' in keywords):
+      summaries['pid'] = cet_stream.stream(cet.iter_with_pid(keywords,block_size=block_size),result_names
+                                          ,prefix and prefix+'_pid.tsv')
+    json.dump(summaries,sys.stdout,indent=2)
+    sys.stdout.write('\n')
+  else:
+    if not ('no-model-data' in keywords):
+      cet.model_data()
+    if not ('no-model-pid' in keywords):
+      cet.model_with_pid(keywords)
+  cet.dump_stats()
@@ -15,9 +15,20 @@ Author:  Brian T. Carcich a.k.a. drbitboy
 Company:  Latchmoor Services, INC
 Initial date:  2021-02-13
 """
+import os
 import sys
+import itertools
 import numpy as np
-import pandas as pd
+import file_cache as fc
+
+### pandas is imported by the readers that use it, so that modules that
+### only need segmented_cummax, or cached arrays, start quickly
+
+### Cache for read_XLSX_cached:  subdirectory of source file's directory,
+### and default size limit of all cached files there
+cache_dirname = '.read_XLSX_cache'
+cache_max_bytes = 256 << 20
+cache_version = 1
 
 def read_XLSX(path,zero_to_20=False,decreasing_backlash=False):
   """
@@ -33,6 +44,7 @@ def read_XLSX(path,zero_to_20=False,decreasing_backlash=False):
 
   """
   ### Read data into Pandas DataFrame
+  import pandas as pd
   df = pd.read_excel(path,sheet_name=1).sort_values(by='DateAndTime',inplace=False)
   ### Convert columns 0 (DateAndTime), 1 (data), -1 (CV/PV indicator) to
   ### Numpy array; convert Timestamp column to offsets in ns, then in s,
@@ -48,64 +60,239 @@ def read_XLSX(path,zero_to_20=False,decreasing_backlash=False):
   ### Get offset times, ensure whole seconds, ensure CVs' offsets = PVs'
   aTimes = rawarr[iw_cv,0]
   assert 1.0<=np.min(aTimes[0,1:]-aTimes[0,:-1]),'Input data include invalid (duplicate) times'
-  assert not [None for rem in aTimes[0] if 0.0!=(rem%1.0)],'Some times are not whole seconds different from others'
+  assert np.all(0.0==np.mod(aTimes,1.0)),'Some times are not whole seconds different from others'
   assert np.alltrue(aTimes==rawarr[iw_pv,0]),'Times are not perfectly paired'
   ### Extract and flatten offset times, CVs, rounded PVs
   aTimes = aTimes.flatten()
   CVs = rawarr[iw_cv,1].flatten()
   PVs = np.round(rawarr[iw_pv,1].flatten(),3)
-  ### Model backlash
-  L = len(CVs)
-  lastCV = -1e32
-  if decreasing_backlash:
-    ### Ensure CV never decreases unless new value is 0
-    for i in range(L):
-      if CVs[i] > lastCV or CVs[i] == 0.0: lastCV = CVs[i]
-      elif CVs[i] < lastCV               : CVs[i] = lastCV
-  ### Check if --zero-to-20 fix is needed
-  if zero_to_20:
-    ### Control valve is opened from 0% to 7ma out of 4-20ma i.e. 3/16
-    ### of range on 0% to 1% output of PIDE; assume 1:1 after that
-    iw_nonzero = np.where(CVs > 0.9999)
-    CVs[iw_nonzero] = CVs[iw_nonzero] + (300./16.)
-    rawarr[iw_cv,1] = CVs
-  ### Include only rows where PV > 0
+  ### Model backlash, apply --zero-to-20 fix, include only rows where
+  ### PV > 0; return offset times, CVs, rounded PVs
+  return preprocess((aTimes,CVs,PVs,),*read_stages(zero_to_20,decreasing_backlash))
+
+########################################################################
+### Preprocessing pipeline:  each stage is a callable taking and returning
+### an (aTimes,CVs,PVs) triple of equal-length arrays, with no Python
+### loop per sample; preprocess applies stages in order
+
+def preprocess(triple,*stages):
+  """Apply preprocessing stages in order to (aTimes,CVs,PVs) triple"""
+  for stage in stages: triple = stage(*triple)
+  return tuple(triple)
+
+
+def read_stages(zero_to_20=False,decreasing_backlash=False):
+  """Return preprocessing stages of read_XLSX with the given options"""
+  stages = list()
+  if decreasing_backlash: stages.append(Backlash())
+  if zero_to_20: stages.append(zero_to_20_stage)
+  stages.append(positive_PV_stage)
+  return stages
+
+
+class Backlash:
+  """
+  Stage:  model backlash; ensure CV never decreases unless new value is 0
+
+  That is a running maximum of CVs that restarts at each CV of 0.  The
+  last CV is kept between calls, so successive blocks of one stream may
+  be passed through the same instance
+
+  """
+  def __init__(self,lastCV=-1e32): self.lastCV = lastCV
+
+  def __call__(self,aTimes,CVs,PVs):
+    starts = np.concatenate(([True],CVs==0.0))
+    blCVs = segmented_cummax(np.concatenate(([self.lastCV],CVs)),starts)[1:]
+    if len(blCVs): self.lastCV = blCVs[-1]
+    return aTimes,blCVs,PVs
+
+
+def zero_to_20_stage(aTimes,CVs,PVs):
+  """
+  Stage:  --zero-to-20 fix; control valve is opened from 0% to 7ma out
+  of 4-20ma i.e. 3/16 of range on 0% to 1% output of PIDE; assume 1:1
+  after that
+
+  """
+  return aTimes,np.where(CVs > 0.9999,CVs + (300./16.),CVs),PVs
+
+
+def positive_PV_stage(aTimes,CVs,PVs):
+  """Stage:  include only rows where PV > 0"""
   iw = np.where(PVs>0.0)
-  ### Return offset times, CVs, rounded PVs
   return aTimes[iw],CVs[iw],PVs[iw]
 
+
+def merge_runs_stage(aTimes,CVs,PVs):
+  """
+  Stage:  merge each run of contiguous duplicate (PV,CV) pairs into its
+  first row, at the mean time of the run; PVs must all be > 0
+
+  """
+  if not len(aTimes): return aTimes,CVs,PVs
+  firsts = np.where(np.concatenate(([True],np.bitwise_or(PVs[1:]!=PVs[:-1],CVs[1:]!=CVs[:-1]))))[0]
+  ns = np.diff(np.concatenate((firsts,[len(aTimes)])))
+  return np.add.reduceat(aTimes,firsts) / ns,CVs[firsts],PVs[firsts]
+
 ########################################################################
-def massage_XLSX(path,zero_to_20=False,decreasing_backlash=False):
+def read_XLSX_cached(path,zero_to_20=False,decreasing_backlash=False
+                    ,cache_dir=None,max_bytes=cache_max_bytes):
   """
-  Read data using read_XLSX above; remove PVs of zero; merge sections of
-  contiguous duplicate data
+  Same as read_XLSX, via an on-disk cache of its result
+
+  The (aTimes,CVs,PVs) arrays are saved as rows of one .npy file in
+  cache_dir (default:  cache_dirname next to path); a cache hit maps that
+  file into memory copy-on-write and returns views of its rows, without
+  a copy, so the arrays are writable, as on a miss, but changes to them
+  stay in memory and never reach the cache file.  The key is the source path, size, mtime and
+  content hash, plus the zero_to_20 and decreasing_backlash options.
+  After each write, least-recently-used files are evicted until the
+  cache directory holds at most max_bytes.  A cache that cannot be
+  written is ignored
+
+  """
+  st = os.stat(path)
+  key = fc.key_digest(cache_version,os.path.abspath(path),st.st_size,st.st_mtime_ns
+                     ,fc.file_digest(path),bool(zero_to_20),bool(decreasing_backlash))
+  if None is cache_dir:
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)),cache_dirname)
+  cache_path = os.path.join(cache_dir,key+'.npy')
+
+  try:
+    arr = np.load(cache_path,mmap_mode='c')
+    fc.touch(cache_path)
+    return arr[0],arr[1],arr[2]
+  except (OSError,ValueError):
+    pass
+
+  triple = read_XLSX(path,zero_to_20=zero_to_20,decreasing_backlash=decreasing_backlash)
+  try:
+    os.makedirs(cache_dir,exist_ok=True)
+    fc.atomic_save(cache_path,lambda fout:np.save(fout,np.vstack(triple)))
+    fc.evict(cache_dir,max_bytes,suffix='.npy',keep=(cache_path,))
+  except OSError as e:
+    sys.stderr.write('WARNING:  not caching [{0}]:  {1}\n'.format(path,e))
+  return triple
+
+########################################################################
+def stream_interleaved(path,block_size=65536,chunk_rows=262144
+                      ,reorder_seconds=3600.0,sep=None
+                      ,zero_to_20=False,decreasing_backlash=False):
+  """
+  Generator:  read CSV/TSV export with the same interleaved layout as the
+  XLSX worksheet read by read_XLSX (1-line header; first column is
+  DateAndTime; second column is CV and PV values; last column is 171 for
+  CVs, not 171 for PVs), in chunks of chunk_rows lines, and yield
+  (aTimes,CVs,PVs) blocks of block_size samples (the last may be shorter)
+
+  The result is the same as read_XLSX with the same options, split into
+  blocks, and so are the checks:  whole-second time offsets from the first time,
+  no duplicate times, and every CV paired with one PV at the same time.
+  Rows may be out of time order by up to reorder_seconds; rows are held
+  back until no row within that window can still arrive, so memory is
+  bounded by chunk_rows, block_size and the rows in that window,
+  however large the file
 
   """
-  aTimes,CVs,PVs = triple= read_XLSX(path,zero_to_20=zero_to_20,decreasing_backlash=decreasing_backlash)
-  lastPV,lastCV,firsti,n = -1e32,-1e32,0,0
-  for i in range(len(aTimes)):
+  with open(path) as fin: header = fin.readline()
+  if None is sep: sep = ('\t' in header) and '\t' or ','
+  ncols = len(header.split(sep))
+  window = int(round(reorder_seconds * 1e9))
+  stages = read_stages(zero_to_20,decreasing_backlash)
+
+  ### Rows held back for reordering; first and last emitted pair times, ns
+  held = (np.zeros(0,dtype=np.int64),np.zeros(0),np.zeros(0,dtype=np.int64),)
+  t0,lastt = None,None
+  ### Samples not yet yielded
+  pending = [np.zeros(0)]*3
+
+  import pandas as pd
+  reader = pd.read_csv(path,sep=sep,usecols=[0,1,ncols-1],chunksize=chunk_rows)
+  for chunk in itertools.chain(reader,[None]):
+
+    if None is chunk:
+      ### End of file:  emit all held rows
+      times,vals,tags = held
+      cutoff = None
+    else:
+      times = pd.to_datetime(chunk.iloc[:,0]).values.astype(np.int64)
+      vals = chunk.iloc[:,1].values.astype(np.float64)
+      tags = chunk.iloc[:,2].values.astype(np.int64)
+      assert (None is lastt) or not len(times) or lastt < times.min(),'Input data are out of time order by more than {0}s'.format(reorder_seconds)
+      times,vals,tags = [np.concatenate(pair) for pair in zip(held,(times,vals,tags,))]
+      cutoff = times.max(initial=np.iinfo(np.int64).min + window) - window
+
+    ### Sort by time, CV before PV
+    iw = np.lexsort((tags != 171,times))
+    times,vals,tags = times[iw],vals[iw],tags[iw]
+    if not (None is cutoff):
+      nemit = np.searchsorted(times,cutoff,side='right')
+      held = times[nemit:],vals[nemit:],tags[nemit:]
+      times,vals,tags = times[:nemit],vals[:nemit],tags[:nemit]
+    if not len(times) and not (None is chunk): continue
 
-    aTimei,CVi,PVi = aTimes[i],CVs[i],PVs[i]
+    ### Check pairing, then time spacing
+    assert 0==(len(times)%2),'Times are not perfectly paired'
+    pairtimes = times[0::2]
+    assert np.all(pairtimes==times[1::2]) and np.all(tags[0::2]==171) and np.all(tags[1::2]!=171),'Times are not perfectly paired'
+    if len(pairtimes):
+      if None is t0: t0 = pairtimes[0]
+      alltimes = pairtimes if None is lastt else np.concatenate(([lastt],pairtimes))
+      assert np.all(np.diff(alltimes) >= 1000000000),'Input data include invalid (duplicate) times'
+      assert np.all(((pairtimes - t0) % 1000000000)==0),'Some times are not whole seconds different from others'
+      lastt = pairtimes[-1]
 
-    if 0.0 >= PVi:
-      if 0==n: firsti = i+1
-      continue
+    ### Offset times, CVs, rounded PVs, preprocessed as by read_XLSX
+    triple = preprocess(((pairtimes - t0) / 1e9,vals[0::2],np.round(vals[1::2],3),),*stages)
+    pending = [np.concatenate(pair) for pair in zip(pending,triple)]
 
-    if lastPV!=PVi or lastCV!=CVi:
-      if n > 1: aTimes[firsti] /= n
-      lastPV,lastCV,firsti,n = PVi,CVi,i,1
-      continue
+    while len(pending[0]) >= block_size:
+      yield tuple([arr[:block_size] for arr in pending])
+      pending = [arr[block_size:] for arr in pending]
 
-    aTimes[firsti] += aTimei
-    PVs[i] = 0.0
-    n += 1
+  if len(pending[0]): yield tuple(pending)
 
-    ### End of loop
 
-  if n > 0: aTimes[firsti] /= n
+def read_interleaved_CSV(path,**kwargs):
+  """Read whole CSV/TSV export via stream_interleaved; return (aTimes,CVs,PVs)"""
+  blocks = list(stream_interleaved(path,**kwargs))
+  if not blocks: return np.zeros(0),np.zeros(0),np.zeros(0)
+  return tuple([np.concatenate(arrs) for arrs in zip(*blocks)])
 
-  iw = np.where(PVs > 0.0)
-  return aTimes[iw], CVs[iw], PVs[iw]
+########################################################################
+def segmented_cummax(values,starts):
+  """
+  Running maximum of values that restarts wherever starts is True; e.g.
+
+    values:  3 5 4 0 2 1
+    starts:  T F F T F F
+    result:  3 5 5 0 2 2
+
+  Values are replaced by their ranks among the unique values, so that
+  (segment, rank) pairs can be combined into one integer key whose plain
+  cumulative maximum is the segmented one; the result is exact
+
+  """
+  values = np.asarray(values)
+  if not len(values): return values.copy()
+  uniqs,ranks = np.unique(values,return_inverse=True)
+  segments = np.cumsum(starts,dtype=np.int64)
+  segments -= segments[0]
+  keys = (segments * len(uniqs)) + ranks
+  return uniqs[np.maximum.accumulate(keys) - (segments * len(uniqs))]
+
+########################################################################
+def massage_XLSX(path,zero_to_20=False,decreasing_backlash=False):
+  """
+  Read data using read_XLSX above; remove PVs of zero; merge sections of
+  contiguous duplicate data
+
+  """
+  return preprocess(read_XLSX(path,zero_to_20=zero_to_20,decreasing_backlash=decreasing_backlash)
+                   ,positive_PV_stage
+                   ,merge_runs_stage
+                   )
 
 ########################################################################
 if "__main__" == __name__:
@@ -117,6 +304,7 @@ if "__main__" == __name__:
           python read_interleaved_XLSX.py [Tank_20_Results_Feb_11-12_2021_R1.xlsx] [--convert-to-tsv[ > Tank_data.txt]]
           python read_interleaved_XLSX.py Tank....xlsx [--massage-tank-data[ --convert-to-tsv  > Tank_data_massage.txt]]
           python read_interleaved_XLSX.py Tank....xlsx [--decreasing-backlash[ --convert-to-tsv > Tank_data_dbacklash.txt]]
+          python read_interleaved_XLSX.py Tank_export.csv [--convert-to-tsv > Tank_data.txt]
 
           N.B. [...] means ... is optional argument(s)
   """
@@ -124,7 +312,11 @@ if "__main__" == __name__:
   zero_to_20 = '--zero-to-20' in sys.argv[1:]
   decreasing_backlash = '--decreasing-backlash' in sys.argv[1:]
 
-  if '--massage-tank-data' in sys.argv[1:]:
+  if not path.lower().endswith(('.xlsx','.xls',)):
+    assert not ('--massage-tank-data' in sys.argv[1:]),'--massage-tank-data is not implemented for CSV/TSV exports'
+    aTimes,CVs,PVs = read_interleaved_CSV(path,zero_to_20=zero_to_20,decreasing_backlash=decreasing_backlash)
+    sys.stderr.write('Method [read_interleaved_CSV] successfully read {1} data from file [{0}]\n'.format(path,len(aTimes)))
+  elif '--massage-tank-data' in sys.argv[1:]:
     aTimes,CVs,PVs = massage_XLSX(path,zero_to_20=zero_to_20,decreasing_backlash=decreasing_backlash)
     sys.stderr.write('Method [massage_XLSX] successfully massaged {1} data from file [{0}]\n'.format(path,len(aTimes)))
   else:
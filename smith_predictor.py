@@ -0,0 +1,73 @@
+import math
+
+class SmithPredictor:
+  """
+Smith predictor around a pid.PID controller
+
+The process model is the SOPDT model fitted by SmithPredictor/SysID_SOPDT.py
+(go_main res.x):  gain k, PV units per CV %; time constants t0 and t1;
+bias c; dead time dt; the time units must be the seconds of Updatetime.
+
+The PID sees the measured PV plus the difference between the model's
+undelayed and delayed outputs, so it acts on the predicted effect of
+its CV changes dt before the measured PV shows it, and the gains are no
+longer limited by the dead time.  Only that difference is used, so the
+bias c cancels out.
+
+The model runs at the PID update interval, as two first-order lags in
+series discretized exactly for a CV held between updates; its outputs
+go into a ring buffer, allocated once, long enough to hold the dead
+time, so each update costs the same whatever the dead time.  A dead time
+that is not a whole number of updates is linearly interpolated between
+buffer entries.
+
+Other attributes (Kc, CVlast, Updatetime, ...) are those of the PID.
+
+  """
+  def __init__(self,ctlpid,k,t0,t1,c=0.0,dt=0.0):
+    """Store PID and SOPDT model; calculate discrete model coefficients"""
+    self.ctlpid = ctlpid
+    self.k,self.t0,self.t1,self.c,self.dt = k,t0,t1,c,dt
+    h = ctlpid.Updatetime
+
+    ### Lag 0:  x0 <- a0*x0 + (1-a0)*k*CV
+    ### Lag 1:  x1 <- a1*x1 + (1-a1)*k*CV + g*(x0 - k*CV), where g is the
+    ###         response at h of lag 1 to a unit exponential decay of lag 0
+    self.a0 = (t0 > 0.0) and math.exp(-h / t0) or 0.0
+    self.a1 = (t1 > 0.0) and math.exp(-h / t1) or 0.0
+    if t0 == t1: self.g = (t0 > 0.0) and ((h / t0) * self.a0) or 0.0
+    else       : self.g = t0 * (self.a0 - self.a1) / (t0 - t1)
+
+    ### Dead time in updates:  whole part and fraction
+    delay = dt / h
+    self.ndelay = int(delay)
+    self.fdelay = delay - self.ndelay
+
+    ### Model state, starting at rest at the PID's last CV
+    self.x0 = self.x1 = k * ctlpid.CVlast
+    self.ring = [self.x1] * (self.ndelay + 2)
+    self.iring = 0
+
+  def __getattr__(self,name):
+    """Delegate other attributes to PID"""
+    if 'ctlpid' == name: raise AttributeError(name)
+    return getattr(self.ctlpid,name)
+
+  def delayed_output(self):
+    """Model output dt ago, from ring buffer"""
+    L = len(self.ring)
+    y0 = self.ring[(self.iring - self.ndelay) % L]
+    y1 = self.ring[(self.iring - self.ndelay - 1) % L]
+    return y0 + (self.fdelay * (y1 - y0))
+
+  def control(self,PVexternal,SPexternal):
+    """Execute one update of PID on predicted PV, then advance model"""
+    PVpredicted = PVexternal + (self.x1 - self.delayed_output())
+    CV = self.ctlpid.control(PVpredicted,SPexternal)
+
+    kCV = self.k * CV
+    self.x1 = (self.a1 * self.x1) + ((1.0 - self.a1) * kCV) + (self.g * (self.x0 - kCV))
+    self.x0 = (self.a0 * self.x0) + ((1.0 - self.a0) * kCV)
+    self.iring = (self.iring + 1) % len(self.ring)
+    self.ring[self.iring] = self.x1
+    return CV
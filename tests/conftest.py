@@ -0,0 +1,4 @@
+### Modules are scripts in the top directory, run from there
+import os
+import sys
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
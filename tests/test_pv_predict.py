@@ -0,0 +1,58 @@
+"""
+Tests of pv_predict.py CET model:  python -m pytest tests
+
+"""
+import warnings
+import numpy as np
+import pytest
+import pv_predict as pvp
+
+def make_cet(**keywords):
+  keywords['no-plot'] = True
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    return pvp.CET(**keywords)
+
+
+@pytest.mark.parametrize('model_time_step',['1','0.3','0.7'])
+@pytest.mark.parametrize('fix_backlash',[False,True])
+def test_event_driven_matches_per_step(model_time_step,fix_backlash):
+  """--event-driven lands PID updates at the same times as the per-step loop, also with a step that does not divide 1 s"""
+  cet = make_cet(**{'model-time-step':model_time_step,'pid-duration':'20000'})
+  keywords = {'fix-backlash':True} if fix_backlash else {}
+  per_step = cet.model_with_pid(dict(keywords))
+  event_driven = cet.model_with_pid(dict(keywords,**{'event-driven':True}))
+  ATs,rPVs = per_step[:2]
+  assert np.array_equal(event_driven[0],ATs)
+  assert np.array_equal(event_driven[1],rPVs)
+  assert np.allclose(event_driven[2],per_step[2],rtol=0.0,atol=1e-9)
+
+
+def test_step_ATs_accumulate_like_one_timestep():
+  cet = make_cet(**{'model-time-step':'0.3'})
+  AT = 45.0
+  expected = []
+  for i in range(1000):
+    AT = cet.model_one_timestep(AT,0.0,0.0,0.0)[0]
+    expected.append(AT)
+  assert np.array_equal(cet.step_ATs(45.0,1000),expected)
+  assert cet.steps_until(45.0,46.0) == 1 + int(np.argmax(np.asarray(expected) >= 46.0))
+
+
+@pytest.mark.parametrize('CVe',[0.9,0.5])
+def test_CVe_at_or_below_CVe0_gives_nan(CVe):
+  """No cooling curve above CVe0:  NaN, not ZeroDivisionError (CVe == CVe0) or complex (CVe < CVe0)"""
+  cet = make_cet(**{'CVe0':'0.9'})
+  cet.set_plant(CVe=CVe)
+  assert cet.cooling_curve.table.dtype == np.float64
+  assert np.isnan(cet.calculate_CVscalar(50.0))
+  assert cet.calculate_CVscalar(0.5) == cet.Ke
+
+
+@pytest.mark.parametrize('CVe',[0.9,0.5])
+def test_plant_residuals_finite_when_CVe_at_or_below_CVe0(CVe):
+  cet = make_cet(**{'CVe0':'0.9'})
+  if None is cet.path: pytest.skip('no recorded data')
+  residuals = pvp.plant_residuals(cet,['CVe'],[CVe])
+  assert np.isrealobj(residuals)
+  assert np.all(np.isfinite(residuals))